@@ -1,11 +1,97 @@
 import re
 import sys
+from sys import intern
 import pprint
 import copy
+import gc
 import itertools
 
 ##
 
+# Columns of a .gff line before col9, stored as slots of each feature.
+_gff_columns = ("scaffold", "source", "type", "start", "end", "score", "strand", "phase")
+# Positions of the columns that hold few distinct values
+_interned_columns = (0, 1, 2, 5, 6, 7)
+
+class Feature:
+  """A .gff feature: its columns are slots and its col9 attributes a dict.
+  Supports the dict access (feature["ID"], "ID" in feature, update) of the
+  dicts features used to be stored as. Unset columns (None) read as missing keys."""
+  __slots__ = _gff_columns + ("attributes",)
+  _fields = frozenset(_gff_columns)
+
+  def __init__(self, fields = None, attributes = None):
+    if fields is None:
+      fields = (None,) * len(_gff_columns)
+    self.scaffold, self.source, self.type, self.start, self.end, self.score, self.strand, self.phase = fields[:len(_gff_columns)]
+    self.attributes = {} if attributes is None else attributes
+
+  def __getitem__(self, key):
+    if key in self._fields:
+      value = getattr(self, key)
+      if value is None:
+        raise KeyError(key)
+      return value
+    return self.attributes[key]
+
+  def __setitem__(self, key, value):
+    if key in self._fields:
+      setattr(self, key, value)
+    else:
+      self.attributes[key] = value
+
+  def __contains__(self, key):
+    if key in self._fields:
+      return getattr(self, key) is not None
+    return key in self.attributes
+
+  def update(self, feature):
+    """Copies the set columns and the attributes of another feature, as dict.update does"""
+    for column in _gff_columns:
+      value = getattr(feature, column)
+      if value is not None:
+        setattr(self, column, value)
+    self.attributes.update(feature.attributes)
+
+##
+
+class Gene(Feature):
+  """A gene, with the IDs of its transcripts as children"""
+  __slots__ = ("children",)
+  _fields = Feature._fields | {"children"}
+
+  def __init__(self, fields = None, attributes = None):
+    Feature.__init__(self, fields, attributes)
+    self.children = []
+
+##
+
+class Transcript(Feature):
+  """A transcript of any of the types in _feature_classes"""
+  __slots__ = ()
+
+##
+
+# Feature class of each feature type parse_gff keeps. Types in
+# _skipped_types are ignored, and any other type is an error.
+_feature_classes = {
+  'gene'       : Gene,
+  'pseudogene' : Gene,
+  'mRNA'       : Transcript,
+  'tRNA'       : Transcript,
+  'rRNA'       : Transcript,
+  'transcript' : Transcript,
+  'exon'       : Feature,
+  'CDS'        : Feature,
+}
+
+_skipped_types = frozenset([
+  "three_prime_UTR", "five_prime_UTR", "region", "non_canonical_three_prime_splice_site",
+  "non_canonical_five_prime_splice_site", "stop_codon_read_through", "repeat_region",
+])
+
+##
+
 def parse_gff(input_gff, source_to_WB = False, seq_region_synonyms = False, has_parentage = True, sources = False):
 
   if seq_region_synonyms:
@@ -18,74 +104,90 @@ def parse_gff(input_gff, source_to_WB = False, seq_region_synonyms = False, has_
   exons       = {}
   CDS         = {}
 
-  for line in gff_fh:
-    if re.match("#", line):
-      continue
-    line = line.rstrip()
-    fields = line.split("\t")
-    if len(fields) != 9:
-      continue
-    this_feature = {
-      'scaffold' : fields[0],
-      'source'   : fields[1],
-      'type'     : fields[2],
-      'start'    : fields[3],
-      'end'      : fields[4],
-      'score'    : fields[5],
-      'strand'   : fields[6],
-      'phase'    : fields[7],
-    }
-
-    if seq_region_synonyms:
-      try:
-        this_feature["scaffold"] = synonyms[fields[0]]    
-      except KeyError:
-        sys.exit("No synonym found for "+fields[0])
-
-    attributes = fields[8].split(";")
-    for attribute_pair in attributes:
-      if re.match("^$", attribute_pair): 
+  def add_gene(feature, line):
+    _add_to_genes(genes, feature, line)
+
+  def add_transcript(feature, line):
+    _add_to_transcripts(transcripts, feature, line)
+    if has_parentage is True:
+      _add_children_to_genes(genes, feature, line)
+
+  def add_exon(feature, line):
+    _add_to_exons(exons, feature, line)
+
+  def add_cds(feature, line):
+    _add_to_cds(CDS, feature, has_parentage = has_parentage, line = line)
+
+  # What to do with each feature, by feature type (see _feature_classes).
+  add_feature = {
+    'gene'       : add_gene,
+    'pseudogene' : add_gene,
+    'mRNA'       : add_transcript,
+    'tRNA'       : add_transcript,
+    'rRNA'       : add_transcript,
+    'transcript' : add_transcript,
+    'exon'       : add_exon,
+    'CDS'        : add_cds,
+  }
+
+  # Features hold no reference cycles, and the cyclic garbage collector
+  # would otherwise go over all those parsed so far again and again.
+  gc_was_enabled = gc.isenabled()
+  gc.disable()
+  try:
+    for line in gff_fh:
+      if line.startswith("#"):
+        continue
+      line = line.rstrip()
+      fields = line.split("\t")
+      if len(fields) != 9:
         continue
-      try:
-        attribute, value = attribute_pair.split("=")
-        this_feature[attribute] = value
-      except:
-        sys.exit("Couldn't parse col9 attributes:\n"+line)
-
-    if this_feature["type"] == "three_prime_UTR" or \
-       this_feature["type"] == "five_prime_UTR" or \
-       this_feature["type"] == "region" or \
-       this_feature["type"] == "non_canonical_three_prime_splice_site" or \
-       this_feature["type"] == "non_canonical_five_prime_splice_site" or \
-       this_feature["type"] == "stop_codon_read_through" or \
-       this_feature["type"] == "repeat_region":
-      continue
-
-    if source_to_WB is True:
-      this_feature["source"] = "WormBase_imported"
-
-    elif sources:
-      try:
-        this_feature["source"] = sources[fields[1]]
-      except KeyError:
-        sys.exit("Don't know what to do with source "+ fields[1])
-
-    if this_feature["type"] == 'gene' or this_feature["type"] == 'pseudogene':
-      genes = _add_to_genes(genes, this_feature)
-
-    elif this_feature["type"] == 'mRNA' or this_feature["type"] == 'tRNA' or this_feature["type"] == 'rRNA' or this_feature["type"] == "transcript":
-      transcripts = _add_to_transcripts(transcripts, this_feature)
-      if has_parentage is True:
-        genes = _add_children_to_genes(genes, this_feature)
-
-    elif this_feature["type"] == 'exon':
-      exons = _add_to_exons(exons, this_feature)
 
-    elif this_feature["type"] == "CDS":
-      CDS = _add_to_cds(CDS, this_feature, has_parentage = has_parentage)
+      if seq_region_synonyms:
+        try:
+          fields[0] = synonyms[fields[0]]    
+        except KeyError:
+          sys.exit("No synonym found for "+fields[0])
 
-    else: 
-      sys.exit("Unexpected feature type\n:"+line)
+      feature_type = fields[2]
+      if feature_type in _skipped_types:
+        continue
+      if feature_type not in _feature_classes:
+        sys.exit("Unexpected feature type\n:"+line)
+
+      attributes = {}
+      for attribute_pair in fields[8].split(";"):
+        if not attribute_pair:
+          continue
+        try:
+          attribute, value = attribute_pair.split("=")
+        except ValueError:
+          sys.exit("Couldn't parse col9 attributes:\n"+line)
+        attributes[intern(attribute)] = value
+
+      # Columns that repeat across features are interned, so that
+      # features share one copy of each value.
+      for column in _interned_columns:
+        fields[column] = intern(fields[column])
+      this_feature = _feature_classes[feature_type](fields, attributes)
+      # Attributes named as a column override it, as when features were dicts.
+      if not Feature._fields.isdisjoint(attributes):
+        for column in Feature._fields.intersection(attributes):
+          setattr(this_feature, column, attributes.pop(column))
+
+      if source_to_WB is True:
+        this_feature.source = "WormBase_imported"
+
+      elif sources:
+        try:
+          this_feature.source = sources[fields[1]]
+        except KeyError:
+          sys.exit("Don't know what to do with source "+ fields[1])
+
+      add_feature[feature_type](this_feature, line)
+  finally:
+    if gc_was_enabled:
+      gc.enable()
 
   transcripts = _fix_pseudogenes(genes, transcripts)
 
@@ -97,7 +199,7 @@ def extract_gene_names(gff):
   fh = open(gff)
   names = []
   for line in fh:
-    if re.match("#", line):
+    if line.startswith("#"):
       continue
     fields = line.split("\t")
     if len(fields) != 9:
@@ -232,15 +334,15 @@ def print_gff(out_file, genes, transcripts, exons, CDS):
 ##
 
 def _print_line(data, feature_type, attributes, out_fh):
-  print(data["scaffold"], data["source"], feature_type, data["start"], data["end"], data["score"], data["strand"], data["phase"], attributes, sep='\t' ,file=out_fh)
+  print(data.scaffold, data.source, feature_type, data.start, data.end, data.score, data.strand, data.phase, attributes, sep='\t' ,file=out_fh)
 
 ##
 
-def _add_to_genes(genes, feature):
-  if "ID" in feature:
-    gene_id = feature["ID"]
-  elif "Name" in feature:
-    gene_id = feature["Name"]
+def _add_to_genes(genes, feature, line = ""):
+  if "ID" in feature.attributes:
+    gene_id = feature.attributes["ID"]
+  elif "Name" in feature.attributes:
+    gene_id = feature.attributes["Name"]
   else:
     sys.exit("Gene has neither an ID nor a Name attribute:\n"+line)
 
@@ -253,9 +355,9 @@ def _add_to_genes(genes, feature):
 
 ##
 
-def _add_to_transcripts(transcripts, feature):
+def _add_to_transcripts(transcripts, feature, line = ""):
   try:
-    transcripts[feature["ID"]] = feature
+    transcripts[feature.attributes["ID"]] = feature
   except KeyError:
     sys.exit("transcript doesn't have an ID attribute:\n"+line)
   return transcripts
@@ -264,51 +366,43 @@ def _add_to_transcripts(transcripts, feature):
 
 ##
 
-def _add_children_to_genes(genes, feature):
-  if "ID" not in feature:
+def _add_children_to_genes(genes, feature, line = ""):
+  if "ID" not in feature.attributes:
     sys.exit("mRNA doesn't have an ID attribute:\n"+line)
-  if "Parent" not in feature:
+  if "Parent" not in feature.attributes:
     sys.exit("mRNA doesn't have a parent attribute:\n"+line)
-  if feature["Parent"] not in genes:
-    genes[feature["Parent"]] = {}
-  if "children" not in genes[feature["Parent"]]:
-    genes[feature["Parent"]]["children"] = [] 
-  genes[feature["Parent"]]["children"].append(feature["ID"])
+  if feature.attributes["Parent"] not in genes:
+    genes[feature.attributes["Parent"]] = Gene()
+  genes[feature.attributes["Parent"]].children.append(feature.attributes["ID"])
 
   return genes
 
 ##
 
-def _add_to_exons(exons, feature):
-  if "Parent" not in feature:
+def _add_to_exons(exons, feature, line = ""):
+  if "Parent" not in feature.attributes:
     sys.exit("exon doesn't have a Parent attribute:\n"+line)
-  if feature["Parent"] not in exons:
-    exons[feature["Parent"]] = []
-  exons[feature["Parent"]].append(feature)
+  exons.setdefault(feature.attributes["Parent"], []).append(feature)
   return exons
 
 ##
 
-def _add_to_cds(CDS, feature, has_parentage=True):
+def _add_to_cds(CDS, feature, has_parentage=True, line = ""):
   if has_parentage is True:
-    if "Parent" not in feature:
+    if "Parent" not in feature.attributes:
       sys.exit("CDS doesn't have a Parent attribute:\n"+line)
-    if feature["Parent"] not in CDS:
-      CDS[feature["Parent"]] = []  
-    CDS[feature["Parent"]].append(feature)
+    CDS.setdefault(feature.attributes["Parent"], []).append(feature)
   else:
-    if feature["ID"] not in CDS:
-      CDS[feature["ID"]] = []
-    CDS[feature["ID"]].append(feature)
+    CDS.setdefault(feature["ID"], []).append(feature)
   return CDS
 
 ##
 
 def _fix_pseudogenes(genes, transcripts):
   for gene in genes:
-    if genes[gene]["type"] == "pseudogene":
-      for child in genes[gene]["children"]:
-        transcripts[child]["type"] = "pseudogenic_transcript" 
+    if genes[gene].type == "pseudogene":
+      for child in genes[gene].children:
+        transcripts[child].type = "pseudogenic_transcript" 
   return transcripts  
 
 ##
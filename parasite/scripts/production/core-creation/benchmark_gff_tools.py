@@ -0,0 +1,159 @@
+#!/hps/software/users/wormbase/parasite/shared/.pyenv/versions/p395/bin/python
+from synthetic_gff import add_synthetic_gff_arguments, write_synthetic_gff, id_prefixes, noise_prefixes
+from ProductionUtils import *
+import csv
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, SUPPRESS
+
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+gfftools_dir = os.path.join(script_dir, "..", "..", "..", "modules", "CoreCreation")
+benchmarked_tools = ["reformat_gff", "reformat_gff_by_scaffold", "gff_utils", "gfftools"]
+benchmark_columns = ["genes", "tool", "stage", "calls", "wall_s", "cpu_s", "peak_rss_delta_mb", "peak_rss_mb"]
+# Gene attribute condition given to reformat_gff's --split_gff_when_gene_attribute
+split_condition = "gene_biotype=ncRNA"
+
+
+# Grabs and returns command line arguments. The synthetic annotation
+# options are those of synthetic_gff.py.
+def get_args():
+    parser = ArgumentParser(description = "Benchmarks reformat_gff.py, gff_utils and gfftools on synthetic annotations "
+                                          "(see synthetic_gff.py), reporting the time and peak memory of each step.")
+    parser.add_argument("output_dir",
+        help = "Directory for the synthetic annotations, the output of each tool and benchmark.tsv.")
+    add_synthetic_gff_arguments(parser)
+    parser.add_argument("--gene_counts", default = None, type = int, nargs = '+',
+        help = "Benchmark an annotation with each of these numbers of genes, instead of --genes.")
+    parser.add_argument("--tools", default = benchmarked_tools, nargs = '+', choices = benchmarked_tools,
+        help = "Tools to benchmark. Default: all of them.")
+    parser.add_argument("--threads", default = 1, type = int,
+        help = "Passed on to reformat_gff.py. Default: 1.")
+    # Used by the benchmark to profile gff_utils or gfftools in a process of their own
+    parser.add_argument("--run_library", default = None, choices = ["gff_utils", "gfftools"], help = SUPPRESS)
+    return parser.parse_args()
+
+
+# The synthetic annotation files of a benchmark case directory
+def _case_files(case_dir):
+    return [os.path.join(case_dir, "synthetic" + suffix) for suffix in [".gff3", ".fa", "_synonyms.tsv"]]
+
+
+# Profiles the main gff_utils functions, in the order reformat_gff.py
+# runs them, on a case directory's annotation. Run in a process of its
+# own, from the tool's subdirectory.
+def profile_gff_utils(case_dir, profiler):
+    from gff_utils import parse_gff, parse_gff_cached, rename_scaffolds, remove_prefixes_from_column_values, \
+        get_parent_gene_for_all, extract_genes_and_features_with_gene_attribute_value, write_output_gff
+    gff_path, fasta_path, synonyms_path = _case_files(case_dir)
+    with profiler.stage("parse_gff"):
+        gff_df = parse_gff(gff_path)
+    for stage in ["parse_gff_cached_cold", "parse_gff_cached_warm"]:
+        with profiler.stage(stage):
+            parse_gff_cached(gff_path, cache_dir = ".")
+    with profiler.stage("rename_scaffolds"):
+        gff_df = rename_scaffolds(gff_df, synonyms_path)
+    with profiler.stage("remove_prefixes"):
+        gff_df = remove_prefixes_from_column_values(gff_df, list(id_prefixes.values()) + noise_prefixes)
+    with profiler.stage("get_parent_gene_for_all"):
+        gff_df = get_parent_gene_for_all(gff_df)
+    with profiler.stage("split_gff"):
+        gff_df, extracted_gff_df = extract_genes_and_features_with_gene_attribute_value(gff_df, split_condition)
+    write_output_gff(gff_df, "out.gff", profiler = profiler)
+
+
+# Profiles gfftools' parsing and printing of a case directory's
+# annotation. Run in a process of its own, from the tool's subdirectory.
+def profile_gfftools(case_dir, profiler):
+    sys.path.insert(0, gfftools_dir)
+    import gfftools
+    gff_path, fasta_path, synonyms_path = _case_files(case_dir)
+    with profiler.stage("parse_gff"):
+        genes, transcripts, exons, CDS = gfftools.parse_gff(gff_path, seq_region_synonyms = synonyms_path)
+    with profiler.stage("print_gff"):
+        gfftools.print_gff("out.gff", genes, transcripts, exons, CDS)
+
+
+# Returns the command that runs a tool on a case directory's annotation
+# and writes its profile to out.gff.profile.tsv.
+def _tool_command(tool, case_dir, threads):
+    if tool in ["gff_utils", "gfftools"]:
+        return [sys.executable, os.path.abspath(__file__), case_dir, "--run_library", tool]
+    gff_path, fasta_path, synonyms_path = _case_files(case_dir)
+    command = [sys.executable, os.path.join(script_dir, "reformat_gff.py"), gff_path, "out.gff", "-f", fasta_path, "-s", synonyms_path,
+               "-p"] + list(id_prefixes.values()) + noise_prefixes + ["--name_prefixes"] + noise_prefixes + \
+              ["--split_gff_when_gene_attribute", split_condition, "--no_gff_cache", "--profile", "--threads", str(threads)]
+    if tool == "reformat_gff_by_scaffold":
+        command.append("--by_scaffold")
+    return command
+
+
+# Runs a tool in its own process, in <case_dir>/<tool>, and returns the
+# stages of its profile, followed by a "total" stage with the wall time,
+# CPU time and peak memory of the whole process. Returns None if the
+# tool fails.
+def run_tool(tool, case_dir, threads):
+    tool_dir = os.path.join(case_dir, tool)
+    os.makedirs(tool_dir, exist_ok = True)
+    with open(os.path.join(tool_dir, "log.txt"), "w") as log_file:
+        wall_start = time.perf_counter()
+        process = subprocess.Popen(_tool_command(tool, os.path.abspath(case_dir), threads), cwd = tool_dir,
+                                   stdout = log_file, stderr = subprocess.STDOUT)
+        # wait4 gives the resource usage of this process alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        wall_time = time.perf_counter() - wall_start
+    if process.returncode != 0:
+        print_warning(tool + " failed, see " + os.path.join(tool_dir, "log.txt"))
+        return None
+
+    with open(os.path.join(tool_dir, "out.gff.profile.tsv")) as profile_file:
+        stages = list(csv.DictReader(profile_file, delimiter = "\t"))
+    # ru_maxrss is in KB on Linux
+    stages.append({"stage": "total", "calls": 1, "wall_s": round(wall_time, 3),
+                   "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+                   "peak_rss_delta_mb": "", "peak_rss_mb": round(usage.ru_maxrss / 1024, 3)})
+    return stages
+
+
+def main():
+    args = get_args()
+
+    if args.run_library:
+        from gff_utils import PROFILER
+        profiler = PROFILER()
+        if args.run_library == "gff_utils":
+            profile_gff_utils(args.output_dir, profiler)
+        else:
+            profile_gfftools(args.output_dir, profiler)
+        profiler.write_reports("out.gff.profile")
+        return
+
+    benchmark_rows = []
+    for genes in (args.gene_counts or [args.genes]):
+        case_dir = os.path.join(args.output_dir, "%d_genes" % genes)
+        os.makedirs(case_dir, exist_ok = True)
+        args.genes = genes
+        write_synthetic_gff(os.path.join(case_dir, "synthetic"), args)
+        for tool in args.tools:
+            print_info("Benchmarking " + tool + " on " + str(genes) + " genes")
+            stages = run_tool(tool, case_dir, args.threads)
+            if stages is None:
+                continue
+            for stage in stages:
+                benchmark_rows.append(dict(stage, genes = genes, tool = tool))
+            total = stages[-1]
+            print_info("%s on %d genes: %ss wall, %ss CPU, %s MB peak memory" % (tool, genes, total["wall_s"], total["cpu_s"], total["peak_rss_mb"]))
+
+    benchmark_tsv = os.path.join(args.output_dir, "benchmark.tsv")
+    with open(benchmark_tsv, "w") as benchmark_file:
+        writer = csv.DictWriter(benchmark_file, fieldnames = benchmark_columns, delimiter = "\t", extrasaction = "ignore")
+        writer.writeheader()
+        writer.writerows(benchmark_rows)
+    print_info("Benchmark written to " + benchmark_tsv)
+
+
+if __name__ == "__main__":
+    main()
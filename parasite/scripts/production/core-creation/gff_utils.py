@@ -1,8 +1,18 @@
 import pandas as pd
 import numpy as np
+import glob
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
 import re
+import resource
 import sys
-from Bio import SeqIO
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from argparse import ArgumentParser
 from datetime import datetime
 from ProductionUtils import *
@@ -20,55 +30,309 @@ from reformat_gff_dependencies import *
 #     return args
 
 
-# Removes provided prefixes from all columns in a .gff3 dataframe.
+# Columns of a parsed .gff dataframe that hold few distinct values and are
+# stored as categoricals. Coordinates are stored as int32 when they fit.
+categorical_gff_columns = ["scaffold", "source", "type", "strand", "phase"]
+coordinate_gff_columns = ["start", "end"]
+
+# Records the wall time, CPU time and peak memory (RSS) growth of named
+# stages of a run (reformat_gff.py --profile). A stage that runs more than
+# once, e.g. once per scaffold, is summed over its calls. Stages can be
+# nested, and then the outer stage includes the inner ones. Disabled
+# profilers time nothing, so code can be written as:
+#     with profiler.stage("parse_gff"):
+#         gff_df = parse_gff(input_gff)
+class PROFILER:
+    report_columns = ["stage", "calls", "wall_s", "cpu_s", "peak_rss_delta_mb", "peak_rss_mb"]
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+
+    @staticmethod
+    def _peak_rss_mb():
+        """Peak RSS of the process so far (ru_maxrss is in KB on Linux)"""
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def _cpu_time():
+        """CPU time of the process and of its finished child processes (e.g. datacheck workers)"""
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return time.process_time() + children.ru_utime + children.ru_stime
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as the stage name"""
+        if not self.enabled:
+            yield
+            return
+        record = self.stages.setdefault(name, dict.fromkeys(self.report_columns, 0))
+        record["stage"] = name
+        peak_rss_before = self._peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = self._cpu_time()
+        try:
+            yield
+        finally:
+            peak_rss = self._peak_rss_mb()
+            record["calls"] += 1
+            record["wall_s"] += time.perf_counter() - wall_start
+            record["cpu_s"] += self._cpu_time() - cpu_start
+            record["peak_rss_delta_mb"] += peak_rss - peak_rss_before
+            record["peak_rss_mb"] = peak_rss
+
+    def write_reports(self, report_prefix):
+        """Writes the stages to <report_prefix>.tsv and <report_prefix>.json"""
+        records = [{column: (round(value, 3) if isinstance(value, float) else value)
+                    for column, value in record.items()} for record in self.stages.values()]
+        with open(report_prefix + ".tsv", 'w') as tsv_file:
+            tsv_file.write("\t".join(self.report_columns) + "\n")
+            for record in records:
+                tsv_file.write("\t".join(str(record[column]) for column in self.report_columns) + "\n")
+        with open(report_prefix + ".json", 'w') as json_file:
+            json.dump(records, json_file, indent=2)
+        print_info("Profile written to " + report_prefix + ".tsv and " + report_prefix + ".json")
+
+no_profiler = PROFILER(enabled=False)
+
+# A step of a STEPGRAPH. function takes and returns a .gff dataframe,
+# inputs and outputs are the columns it reads and writes ("features" for
+# steps that add or drop features), and is_clean, if given, is a cheap
+# check that the dataframe needs nothing from the step. message is logged
+# when the step runs.
+class STEP:
+    def __init__(self, name, function, inputs, outputs, is_clean=None, message=None):
+        self.name = name
+        self.function = function
+        self.inputs = set(inputs)
+        self.outputs = set(outputs)
+        self.is_clean = is_clean
+        self.message = message
+
+# Graph of the steps run on a .gff dataframe, in the order they are added.
+# A step depends on the earlier steps that write one of its inputs. The
+# graph is lazy: run only runs the steps that the targets (the columns
+# needed afterwards) depend on, and skips a step if its is_clean check
+# passes on the dataframe as the earlier steps left it.
+class STEPGRAPH:
+    def __init__(self):
+        self.steps = []
+
+    def add(self, step):
+        self.steps.append(step)
+
+    def needed_steps(self, targets):
+        """Returns the steps that write the targets, or the inputs of another needed step"""
+        needed_columns = set(targets)
+        needed_steps = []
+        for step in reversed(self.steps):
+            if step.outputs & needed_columns:
+                needed_steps.insert(0, step)
+                needed_columns |= step.inputs
+        return needed_steps
+
+    def run(self, gff_df, targets, log=print_info, profiler=no_profiler):
+        """Runs the steps needed for targets on gff_df and returns the result"""
+        needed_steps = self.needed_steps(targets)
+        for step in self.steps:
+            if step not in needed_steps:
+                log("Skipping " + step.name + ": its output is not used")
+                continue
+            if step.is_clean is not None:
+                with profiler.stage("check_" + step.name):
+                    is_clean = step.is_clean(gff_df)
+                if is_clean:
+                    log("Skipping " + step.name + ": nothing to change")
+                    continue
+            if step.message is not None:
+                log(step.message)
+            with profiler.stage(step.name):
+                gff_df = step.function(gff_df)
+        return gff_df
+
+# Stores the columns of a .gff dataframe in compact types: categoricals for
+# categorical_gff_columns and int32 for coordinates that fit in it.
+# Called after parsing and after steps that add features or replace whole
+# columns, which turn categoricals back into object columns.
+def _compact_gff_dtypes(gff_df):
+    for column in categorical_gff_columns:
+        if column in gff_df.columns and not isinstance(gff_df[column].dtype, pd.CategoricalDtype):
+            gff_df[column] = gff_df[column].astype("category")
+    # Coordinates beyond the int32 range stay int64 rather than wrap around.
+    int32_range = np.iinfo(np.int32)
+    for column in coordinate_gff_columns:
+        if column in gff_df.columns and gff_df[column].dtype != np.int32 and gff_df[column].notna().all() and \
+                (gff_df[column].empty or int32_range.min <= gff_df[column].min() and gff_df[column].max() <= int32_range.max):
+            gff_df[column] = gff_df[column].astype(np.int32)
+    return gff_df
+
+# Sets a column to value for the features in mask. Categorical columns get
+# value added to their categories first, as they refuse unknown values.
+def _set_column_value(gff_df, mask, column, value):
+    if isinstance(gff_df[column].dtype, pd.CategoricalDtype) and value not in gff_df[column].cat.categories:
+        gff_df[column] = gff_df[column].cat.add_categories([value])
+    gff_df.loc[mask, column] = value
+    return gff_df
+
+# Replaces values in a categorical column by replacing in its categories,
+# i.e. once per distinct value rather than once per feature. Categories
+# that end up the same are merged.
+def _replace_categorical_values(column, to_replace, value, regex = False):
+    categories = column.cat.categories
+    new_categories = pd.Series(categories, dtype = object).replace(to_replace, value, regex = regex)
+    return column.map(dict(zip(categories, new_categories))).astype("category")
+
+# Columns holding scaffold or feature IDs, which are the ones prefixes are
+# removed from.
+id_gff_columns = ["scaffold", "ID", "Parent", "Name", "Derives_from"]
+
+# Compiles prefixes (regular expressions) into a single alternation, so
+# that removing all of them takes one pass over each value.
+def _compile_prefixes(prefixes):
+    return re.compile("|".join("(?:" + prefix + ")" for prefix in prefixes))
+
+# Removes the prefixes regex from a column: from its categories if it is
+# categorical, from every string value otherwise.
+def _remove_prefixes_from_column(column, prefixes_regex):
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return _replace_categorical_values(column, prefixes_regex, "", regex=True)
+    if column.dtype == object:
+        return column.str.replace(prefixes_regex, "", regex=True)
+    return column
+
+# Checks if any value of the given columns has one of the prefixes. The
+# values of a column are searched in one go, joined by newlines, with ^
+# and $ matching at the start and end of each value. Prefixes without
+# regular expression syntax are looked for as plain text, which is faster.
+def has_prefixes(gff_df, prefixes, columns = id_gff_columns):
+    if all(re.escape(prefix) == prefix.replace("-", "\\-") for prefix in prefixes):
+        contains_prefix = lambda text: any(prefix in text for prefix in prefixes)
+    else:
+        contains_prefix = re.compile(_compile_prefixes(prefixes).pattern, re.MULTILINE).search
+    for column in columns:
+        if column not in gff_df.columns:
+            continue
+        values = gff_df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.categories
+        elif values.dtype != object:
+            continue
+        if contains_prefix("\n".join(values.dropna())):
+            return True
+    return False
+
+# Removes provided prefixes from the ID columns (id_gff_columns) of a
+# .gff3 dataframe.
 def remove_prefixes_from_column_values(gff_df, prefixes):
-    gff_df = gff_df.replace(prefixes, "", regex=True)
+    prefixes_regex = _compile_prefixes(prefixes)
+    for column in id_gff_columns:
+        if column in gff_df.columns:
+            gff_df[column] = _remove_prefixes_from_column(gff_df[column], prefixes_regex)
     return gff_df
 
 # Removes provided prefixes from the 'Name' column in a .gff3 dataframe.
 def remove_prefixes_from_name_column(gff_df, prefixes):
-    gff_df['Name'] = gff_df['Name'].replace(prefixes, "", regex=True)
+    gff_df['Name'] = _remove_prefixes_from_column(gff_df['Name'], _compile_prefixes(prefixes))
     return gff_df
 
 # Takes a GFF dataframe and adds a column for each attribute specified
 # in the attributes column (column 9). Does not remove the original
 # attributes column. NaN inserted where features lack a value for an
-# attribute.
+# attribute. Values are kept as they are (e.g. percent-encoding is not
+# decoded).
 def _parse_attributes_field(gff_df):
 
-    # Iterate over rows as tuples (~3x faster than iterrows)
-    # Column 0 is index, column 9 is attributes
-    for row in gff_df.itertuples():
-
-        # .gff attributes are delimited by ';'
-        attribute_fields = row[9].split(';')
-
-        for attribute_field in attribute_fields:
-
-            # Skip empty rows output by .split
-            if attribute_field != "":
-
-                # Format is "attribute"="value"
-                attribute_name = attribute_field.split('=')[0]
-                attribute_value = attribute_field.split('=')[1]
-                gff_df.at[row[0], attribute_name] = attribute_value
+    # .gff attributes are delimited by ';'. Split them all at once, giving
+    # one row per attribute field that keeps the index of its feature.
+    attribute_fields = gff_df["attributes"].str.split(';').explode()
+
+    # Skip empty fields output by .split
+    attribute_fields = attribute_fields[attribute_fields.notna() & (attribute_fields != "")]
+    if attribute_fields.empty:
+        return gff_df
+
+    # Format is "attribute"="value". Anything after a second '=' is
+    # dropped, as the value is the second '='-delimited field.
+    attribute_pairs = attribute_fields.str.split('=', n=2, expand=True)
+    if 1 not in attribute_pairs.columns or attribute_pairs[1].isna().any():
+        malformed = attribute_fields[~attribute_fields.str.contains('=', regex=False)]
+        exit_with_error("Couldn't parse col9 attributes: " + ", ".join(malformed.unique()[:10]))
+    attribute_pairs = pd.DataFrame({"feature": attribute_pairs.index,
+                                    "attribute_name": attribute_pairs[0].values,
+                                    "attribute_value": attribute_pairs[1].values})
+
+    attribute_order = pd.unique(attribute_pairs["attribute_name"])
+
+    # The last value wins when an attribute is repeated within a feature.
+    attribute_pairs = attribute_pairs.drop_duplicates(subset=["feature", "attribute_name"], keep="last")
+
+    # Pivot to one column per attribute, in order of first appearance
+    attribute_df = attribute_pairs.pivot(index="feature", columns="attribute_name", values="attribute_value")
+    attribute_df = attribute_df.reindex(columns=attribute_order)
+    attribute_df.columns.name = None
+    attribute_df.index.name = gff_df.index.name
+
+    new_columns = [column for column in attribute_df.columns if column not in gff_df.columns]
+    gff_df = gff_df.join(attribute_df[new_columns])
+    for column in attribute_df.columns:
+        if column not in new_columns:
+            values = attribute_df[column].dropna()
+            gff_df.loc[values.index, column] = values
 
     return gff_df
 
 
 # Makes IDs unique by adding | N as a suffix, where N is the cumulative
 # occurence of a non-unique ID. The first occurence is left unchanged.
-def _make_ids_unique(gff_df):
-    # Suffixes cumulative count to a value.
-    def _convert_count_to_unique_suffix(count):
-        # 0 indicates first instance of non-unique ID -> empty string.
-        if count == 0:
-            return ""
-        else:
-            return "|" + str(count)
-
-    # Modify all non-unique IDs with their cumulative count.
-    gff_df["ID"] += gff_df.groupby("ID").cumcount().apply(_convert_count_to_unique_suffix)
+# Parents are changed the same way, to the occurence of their ID closest
+# above the child, so that children of a repeated ID stay with their own
+# copy of it. seen_id_counts (ID -> occurences so far) carries the count
+# over from previously parsed parts of the same .gff and is updated in place.
+def _make_ids_unique(gff_df, seen_id_counts=None):
+    if "ID" not in gff_df.columns:
+        return gff_df
+    ids = gff_df["ID"].values
+    parents = gff_df["Parent"].values if "Parent" in gff_df.columns else np.full(len(ids), np.nan, dtype = object)
+
+    # Parents get the code of their ID, -1 if it is not an ID.
+    id_codes, unique_ids = pd.factorize(ids)
+    parent_codes = pd.Index(unique_ids).get_indexer(parents)
+    id_rows = np.flatnonzero(id_codes >= 0)
+    child_rows = np.flatnonzero(parent_codes >= 0)
+
+    # Children and IDs are sorted together by (code, row), children first
+    # on ties. The occurences of an ID above a row are then the IDs between
+    # the start of its code and its position: the cumulative count of an
+    # ID, and the number of occurences of its Parent's ID above a child.
+    key_stride = len(ids) + 1
+    keys = np.concatenate([parent_codes[child_rows] * key_stride + child_rows, id_codes[id_rows] * key_stride + id_rows])
+    order = np.argsort(keys, kind = "stable")
+    sorted_is_id = order >= len(child_rows)
+    ids_before = np.cumsum(sorted_is_id) - sorted_is_id
+    sorted_codes = keys[order] // key_stride
+    code_starts = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    # ids_before never decreases, so its running max over the code starts
+    # is its value at the start of each position's code.
+    counts = np.empty(len(keys), dtype = np.int64)
+    counts[order] = ids_before - np.maximum.accumulate(np.where(code_starts, ids_before, 0))
+    parent_counts, id_counts = counts[:len(child_rows)], counts[len(child_rows):]
+
+    if seen_id_counts is not None:
+        seen_counts = pd.Series(unique_ids).map(seen_id_counts).fillna(0).astype(np.int64).values
+        id_counts += seen_counts[id_codes[id_rows]]
+        parent_counts += seen_counts[parent_codes[child_rows]]
+        part_counts = np.bincount(id_codes[id_rows], minlength = len(unique_ids))
+        in_part = np.flatnonzero(part_counts)
+        seen_id_counts.update(zip(unique_ids[in_part], (seen_counts + part_counts)[in_part].tolist()))
+
+    # Modify all non-unique IDs with their cumulative count, and Parents
+    # with N occurences of their ID above them to the one suffixed N - 1.
+    for column, values, rows, suffixes in [("ID", ids, id_rows[id_counts > 0], id_counts[id_counts > 0]),
+                                           ("Parent", parents, child_rows[parent_counts > 1], parent_counts[parent_counts > 1] - 1)]:
+        if len(rows) > 0:
+            values = values.copy()
+            values[rows] = values[rows] + "|" + suffixes.astype(str).astype(object)
+            gff_df[column] = values
     return gff_df
 
 
@@ -76,17 +340,133 @@ def _make_ids_unique(gff_df):
 # modified but the attributes column is parsed into separate columns,
 # one for each identified attribute (e.g. ID, Name, Parent).
 # Attributes not present in the original .gff file are NOT added.
-def parse_gff(input_gff):
+def parse_gff(input_gff, dtype = None, seen_id_counts = None):
     col_names = ["scaffold", "source", "type", "start", "end", "score", "strand", "phase", "attributes"]
 
-    gff_df = pd.read_csv(input_gff, sep = '\t', comment = '#', names = col_names, index_col = False)
+    gff_df = pd.read_csv(input_gff, sep = '\t', comment = '#', names = col_names, index_col = False, dtype = dtype)
 
     gff_df = _parse_attributes_field(gff_df)
 
-    gff_df = _make_ids_unique(gff_df)
+    gff_df = _make_ids_unique(gff_df, seen_id_counts)
+
+    gff_df = _compact_gff_dtypes(gff_df)
 
     return gff_df
 
+# Version of the dataframe returned by parse_gff. Bump it whenever
+# parse_gff changes what it returns, so that parses cached by older
+# versions (see parse_gff_cached) are not reused.
+parse_gff_version = "2"
+
+# Returns the SHA-256 hex digest of a file, read in 1MB blocks.
+def _file_sha256(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+# As parse_gff, but caches the parsed dataframe as a Feather file in
+# cache_dir (by default the .gff's directory) and reuses it on later runs.
+# The cache file is named after the .gff's SHA-256 and parse_gff_version,
+# so it is only used for the same content parsed by the same version of
+# parse_gff. Older caches of the same .gff are removed. Parses without
+# caching if pyarrow is not installed or the cache can't be written.
+def parse_gff_cached(input_gff, cache_dir = None):
+    try:
+        import pyarrow
+    except ImportError:
+        print_warning("pyarrow is not installed: the parsed .gff won't be cached.")
+        return parse_gff(input_gff)
+
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(input_gff))
+    cache_prefix = os.path.join(cache_dir, os.path.basename(input_gff) + ".parsed.")
+    cache_file = cache_prefix + _file_sha256(input_gff)[:16] + ".v" + parse_gff_version + ".feather"
+
+    if os.path.isfile(cache_file):
+        print_info("Reading the parsed .gff from cache: " + cache_file)
+        gff_df = pd.read_feather(cache_file)
+        # Feather gives None for missing strings, parse_gff gives NaN.
+        for column in gff_df.columns:
+            if gff_df[column].dtype == object:
+                gff_df[column] = gff_df[column].fillna(np.nan)
+        return gff_df
+
+    gff_df = parse_gff(input_gff)
+    try:
+        gff_df.to_feather(cache_file + ".part")
+        os.replace(cache_file + ".part", cache_file)
+    except (OSError, ValueError, pyarrow.ArrowException) as cache_error:
+        print_warning("Could not cache the parsed .gff in " + cache_dir + ": " + str(cache_error))
+        if os.path.isfile(cache_file + ".part"):
+            os.remove(cache_file + ".part")
+        return gff_df
+    print_info("Cached the parsed .gff: " + cache_file)
+    for old_cache_file in glob.glob(glob.escape(cache_prefix) + "*.feather"):
+        if old_cache_file != cache_file:
+            os.remove(old_cache_file)
+    return gff_df
+
+# Scans a .gff file once and returns, for each scaffold in order of first
+# appearance, the byte ranges holding its features. Consecutive features
+# of a scaffold share one range (comment lines in between are left for
+# parse_gff to skip), so a .gff grouped by scaffold gives one range per
+# scaffold. Stops at a ##FASTA section.
+def index_gff_scaffolds(input_gff):
+    if input_gff.endswith(".gz"):
+        exit_with_error("Processing scaffold by scaffold needs an uncompressed .gff file: " + input_gff)
+    scaffold_ranges = {}
+    previous_scaffold = None
+    offset = 0
+    with open(input_gff, 'rb') as gff:
+        for line in gff:
+            line_end = offset + len(line)
+            if line.startswith(b"##FASTA"):
+                break
+            if not line.startswith(b"#") and line.strip():
+                scaffold = line.split(b"\t", 1)[0].decode()
+                if scaffold == previous_scaffold:
+                    scaffold_ranges[scaffold][-1][1] = line_end
+                else:
+                    scaffold_ranges.setdefault(scaffold, []).append([offset, line_end])
+                    previous_scaffold = scaffold
+            offset = line_end
+    return scaffold_ranges
+
+# Groups the scaffolds of index_gff_scaffolds, in order, into batches of
+# at most max_bytes of .gff text (a larger scaffold is a batch of its
+# own). Returns the byte ranges of each batch.
+def batch_gff_scaffolds(scaffold_ranges, max_bytes):
+    batches = []
+    batch_bytes = 0
+    for ranges in scaffold_ranges.values():
+        scaffold_bytes = sum(end - start for start, end in ranges)
+        if not batches or batch_bytes + scaffold_bytes > max_bytes:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].extend(ranges)
+        batch_bytes += scaffold_bytes
+    return batches
+
+# Parses the features of one or more scaffolds, located by
+# index_gff_scaffolds, as parse_gff does for a whole file. Text columns
+# are read as strings so all scaffolds get the same types, and the ID,
+# Name and Parent columns are always present even if no feature of the
+# scaffolds has them.
+def parse_gff_scaffold(input_gff, scaffold_ranges, seen_id_counts = None):
+    with open(input_gff, 'rb') as gff:
+        scaffold_lines = []
+        for start, end in scaffold_ranges:
+            gff.seek(start)
+            scaffold_lines.append(gff.read(end - start))
+    text_columns = {"scaffold": str, "source": str, "type": str, "score": str, "strand": str, "phase": str}
+    gff_df = parse_gff(io.BytesIO(b"".join(scaffold_lines)), dtype = text_columns, seen_id_counts = seen_id_counts)
+    for column in ["ID", "Name", "Parent"]:
+        if column not in gff_df.columns:
+            gff_df[column] = np.nan
+    return gff_df
+
 # Replaces INSDCID scaffold names with community scaffold names using
 # synonyms mapping provided in a synonyms.tsv file.
 # TODO: Spits out NaNs as scaffold names if the .gff is already using
@@ -98,7 +478,8 @@ def rename_scaffolds(gff_df, synonyms_file):
     scaffold_df = pd.read_csv (synonyms_file, sep = '\t', names = colnames, usecols = ["CommunityID", "INSDCID"])
     scaffold_df.set_index("INSDCID", inplace = True)
     ren_gff_df = gff_df.copy()
-    ren_gff_df.loc[:, "scaffold"] = ren_gff_df["scaffold"].map(scaffold_df["CommunityID"])
+    # A new column rather than a .loc write: scaffold is categorical
+    ren_gff_df["scaffold"] = ren_gff_df["scaffold"].astype(object).map(scaffold_df["CommunityID"])
 
     # If all gff_gf["scaffold"] values are "NaN", then it's already using community IDs
     # and we don't want to overwrite them.
@@ -189,6 +570,8 @@ def extrapolate_scaffold_transcripts_from_genes(gff_df, scaffold, suffix = "_mRN
     # Update scaffold CDS to point to extrapolated transcripts as parents
     gff_df = _update_scaffold_cds_parent_attribute(gff_df, scaffold)
 
+    gff_df = _compact_gff_dtypes(gff_df)
+
     return gff_df
 
 
@@ -221,6 +604,8 @@ def extrapolate_scaffold_genes_from_transcripts(gff_df, scaffold, suffix = "_gen
     # Add extrapolated genes to .gff
     gff_df = pd.concat([gff_df, scaffold_genes]).reset_index()
 
+    gff_df = _compact_gff_dtypes(gff_df)
+
     return gff_df
 
 
@@ -247,6 +632,8 @@ def extrapolate_scaffold_exons_from_cds(gff_df, scaffold):
 
     gff_df = pd.concat([gff_df, scaffold_exons]).reset_index()
 
+    gff_df = _compact_gff_dtypes(gff_df)
+
     return gff_df
 
 
@@ -270,6 +657,8 @@ def extrapolate_scaffold_cds_from_exons(gff_df, scaffold):
 
     gff_df = pd.concat([gff_df, scaffold_cds]).reset_index()
 
+    gff_df = _compact_gff_dtypes(gff_df)
+
     return gff_df
 
 
@@ -293,13 +682,13 @@ def add_prefix_to_name(gff_df, prefix):
     return gff_df
 
 def make_coding_transcripts_mRNA(gff_df):
-    gff_df.loc[gff_df['type'].isin(coding_transcript_types), ['type']] = 'mRNA'
+    gff_df = _set_column_value(gff_df, gff_df['type'].isin(coding_transcript_types), 'type', 'mRNA')
     return(gff_df)
 
 
 # Replaces names in source column with provided argument.
 def rename_sources(gff_df, new_source):
-    gff_df["source"] = new_source
+    gff_df["source"] = pd.Series(new_source, index = gff_df.index, dtype = "category")
     return gff_df
 
 
@@ -338,92 +727,285 @@ def get_all_exon_and_cds_features(gff_df, transcripts=None):
         exon_cds_df = gff_df[((gff_df["type"] == "CDS") | (gff_df["type"] == "exon")) & (gff_df["Parent"].isin(transcripts))]
     return exon_cds_df
 
-# This function takes a dataframe grouped by the "Parent" column and
-# returns a pandas Series with the exon/cds metrics below.
+# This function takes a dataframe of exon and CDS features and returns a
+# dataframe, indexed by transcript (the features' "Parent"), with the
+# exon/cds metrics below. Coordinates are NaN where a transcript has no
+# exons or no CDSs. All transcripts are counted in a single grouped
+# aggregation over (Parent, exon or CDS).
 # This function is being used by the transcripts_have_exons_and_valid_cds datacheck.
-def _count_cds_exons_per_transcript(gff_df):
-    exons_cds_stats = {
-        'no_of_exons': gff_df[gff_df['type']=='exon']['Parent'].count(),
-        'no_of_cds': gff_df[gff_df['type']=='CDS']['Parent'].count(),
-        'exons_max_coord': max([gff_df[gff_df['type']=='exon']["start"].max(),gff_df[gff_df['type']=='exon']["end"].max()]),
-        'exons_min_coord': min([gff_df[gff_df['type']=='exon']["start"].min(),gff_df[gff_df['type']=='exon']["end"].min()]),
-        'cds_max_coord': max([gff_df[gff_df['type']=='CDS']["start"].max(),gff_df[gff_df['type']=='CDS']["end"].max()]),
-        'cds_min_coord': min([gff_df[gff_df['type']=='CDS']["start"].min(),gff_df[gff_df['type']=='CDS']["end"].min()]),
-    }
-    return pd.Series(exons_cds_stats)
-
-def get_parent_gene_for_all(gff_df):
-    gff_df.set_index("ID", drop = False, inplace = True)
-
-    gene_df = get_all_gene_features(gff_df)
-    transcript_df = get_all_transcript_features(gff_df)
-    exon_df = get_all_exon_features(gff_df)
-    cds_df = get_all_cds_features(gff_df)
-
-    # Create a "Parent Gene" column for each feature to allow sorting.
-    gene_df = _get_parent_gene_for_genes(gene_df)
-
-    transcript_df  = _get_parent_gene_for_transcripts(transcript_df)
-
-    exon_df = _get_parent_gene_for_exons_or_cds(exon_df, transcript_df)
-    # exon_df.to_csv("exond_df.tsv", sep = '\t')
-
-    cds_df = _get_parent_gene_for_exons_or_cds(cds_df, transcript_df)
-    # cds_df.to_csv("cds_df.tsv", sep = '\t')
-
-    # Stick all features together and sort them by parent gene.
-    reordered_gff = pd.concat([gene_df, transcript_df, exon_df, cds_df])
+def _count_cds_exons_per_transcript(exons_cds_df):
+    start = exons_cds_df["start"].values
+    end = exons_cds_df["end"].values
+    feature_coords_df = pd.DataFrame({"Parent": exons_cds_df["Parent"].values,
+                                      "feature": np.where(exons_cds_df["type"] == "exon", "exons", "cds"),
+                                      "min_coord": np.minimum(start, end),
+                                      "max_coord": np.maximum(start, end)})
+    feature_stats_df = feature_coords_df.groupby(["Parent", "feature"]).agg(no_of=("min_coord", "size"),
+                                                                           min_coord=("min_coord", "min"),
+                                                                           max_coord=("max_coord", "max"))
+    feature_stats_df = feature_stats_df.unstack("feature")
+
+    exons_cds_stats = pd.DataFrame(index = feature_stats_df.index)
+    for feature in ["exons", "cds"]:
+        if ("no_of", feature) in feature_stats_df.columns:
+            exons_cds_stats['no_of_' + feature] = feature_stats_df[("no_of", feature)].fillna(0).astype(int)
+            exons_cds_stats[feature + '_max_coord'] = feature_stats_df[("max_coord", feature)]
+            exons_cds_stats[feature + '_min_coord'] = feature_stats_df[("min_coord", feature)]
+        else:
+            exons_cds_stats['no_of_' + feature] = 0
+            exons_cds_stats[feature + '_max_coord'] = np.nan
+            exons_cds_stats[feature + '_min_coord'] = np.nan
+    return exons_cds_stats
+
+# Datachecks whose fix also drops the CDSs of the offending transcripts
+_cds_dropping_checks = ["cds_but_no_exons", "cds_within_exons"]
+
+# Finds the coding transcripts of a .gff dataframe that fail the
+# datachecks of DATACHECK.transcripts_have_exons_and_valid_cds. Returns
+# two dicts from each check (cds_but_no_exons, cds_within_exons,
+# coding_transcripts_with_cds) in checks: to its offending transcript IDs,
+# sorted, and, for the _cds_dropping_checks, to the rows of their CDSs.
+# Only reads the dataframe, so it can run on parts of it.
+def _find_offending_transcripts(gff_df, checks):
+    offending_transcripts = {check: [] for check in checks}
+    offending_cds_rows = {check: np.array([], dtype=int) for check in checks if check in _cds_dropping_checks}
+    hierarchy = HIERARCHY(gff_df)
+    coding_transcript_mask = gff_df["type"].isin(coding_transcript_types).values
+    exons_cds_df = gff_df[(hierarchy.is_exon | hierarchy.is_cds) & hierarchy.children_mask(np.flatnonzero(coding_transcript_mask))]
+    if exons_cds_df.empty:
+        # Nothing to check (e.g. a scaffold without coding transcripts)
+        return offending_transcripts, offending_cds_rows
+    counts_per_transcript_df = _count_cds_exons_per_transcript(exons_cds_df)
+    check_masks = {"cds_but_no_exons": lambda counts: (counts['no_of_exons']==0) & (counts['no_of_cds']>0),
+                   "cds_within_exons": lambda counts: (counts['exons_max_coord'] < counts['cds_max_coord']) |
+                                                      (counts['exons_min_coord'] > counts['cds_min_coord']),
+                   "coding_transcripts_with_cds": lambda counts: counts['no_of_cds']==0}
+    for check in checks:
+        offending_transcripts[check] = counts_per_transcript_df[check_masks[check](counts_per_transcript_df)].index.values.tolist()
+        if check in offending_cds_rows and offending_transcripts[check]:
+            transcript_rows = hierarchy.rows_with_ids(offending_transcripts[check], mask=hierarchy.is_transcript)
+            offending_cds_rows[check] = np.flatnonzero(hierarchy.is_cds & hierarchy.children_mask(transcript_rows))
+    return offending_transcripts, offending_cds_rows
+
+# State shared with the datacheck worker processes. The pool is forked
+# after it is set, so workers see the parent's dataframe copy-on-write
+# instead of receiving a serialised copy of their part of it.
+_datacheck_worker_state = {}
+
+def _find_offending_transcripts_in_rows(row_range):
+    """Worker: _find_offending_transcripts for a range of the shared scaffold-sorted rows"""
+    gff_df = _datacheck_worker_state["gff_df"]
+    rows = _datacheck_worker_state["rows"][row_range[0]:row_range[1]]
+    # Only the columns the checks read
+    rows_df = pd.DataFrame({column: gff_df[column].values[rows] for column in ["type", "start", "end", "ID", "Parent"]})
+    offending_transcripts, offending_cds_rows = _find_offending_transcripts(rows_df, _datacheck_worker_state["checks"])
+    return offending_transcripts, {check: rows[cds_rows] for check, cds_rows in offending_cds_rows.items()}
+
+# Splits the rows of a .gff dataframe into about tasks_per_process *
+# processes ranges of whole scaffolds with similar numbers of features.
+# Returns the row positions sorted by scaffold and the (start, end) ranges.
+def _scaffold_row_ranges(gff_df, processes, tasks_per_process=2):
+    scaffold_codes = pd.factorize(gff_df["scaffold"])[0]
+    rows = np.argsort(scaffold_codes, kind="stable")
+    scaffold_starts = np.flatnonzero(np.diff(scaffold_codes[rows])) + 1
+    targets = np.linspace(0, len(rows), processes * tasks_per_process + 1)[1:-1]
+    nearest = np.searchsorted(scaffold_starts, targets)
+    cuts = np.unique(scaffold_starts[nearest[nearest < len(scaffold_starts)]])
+    bounds = [0] + cuts.tolist() + [len(rows)]
+    return rows, list(zip(bounds[:-1], bounds[1:]))
+
+# Class holding the parent/child links of the features of a gff dataframe,
+# built in a single pass: every feature (row) gets the row of its parent,
+# from which its gene, its children and orphans follow by array lookups
+# instead of merges on Parent. Rows are positions in the dataframe when
+# the class is built, and index holds their labels.
+class HIERARCHY:
+    def __init__(self, gff_df):
+        self.index = gff_df.index
+        self.ids = gff_df["ID"].values
+        self.parents = gff_df["Parent"].values
+        self.is_gene = gff_df["type"].isin(gene_types).values
+        self.is_transcript = gff_df["type"].isin(transcript_types).values
+        self.is_exon = (gff_df["type"] == "exon").values
+        self.is_cds = (gff_df["type"] == "CDS").values
+
+        # Row of each feature's parent, -1 if its parent is not in the
+        # dataframe. An ID found more than once points to its first feature.
+        # IDs and Parents are hashed together in one factorize.
+        codes, unique_ids = pd.factorize(np.concatenate([self.ids, self.parents]))
+        id_codes, parent_codes = codes[:len(self.ids)], codes[len(self.ids):]
+        id_rows = np.flatnonzero(id_codes >= 0)
+        found_id_codes, first_positions = np.unique(id_codes[id_rows], return_index = True)
+        first_row_of_id = np.full(len(unique_ids) + 1, -1)
+        first_row_of_id[found_id_codes] = id_rows[first_positions]
+        # Parent code -1 (no Parent) picks the extra last element, -1.
+        self.parent_rows = first_row_of_id[parent_codes]
+
+    def rows_with_ids(self, ids, mask = None):
+        """Returns the rows of the features with one of the given IDs, optionally restricted to a mask"""
+        rows_mask = pd.Series(self.ids).isin(ids).values
+        if mask is not None:
+            rows_mask &= mask
+        return np.flatnonzero(rows_mask)
+
+    def children_mask(self, rows):
+        """Returns a mask of the features whose parent is one of the given rows"""
+        # The extra last element is False and is what parent row -1 points to.
+        is_parent = np.zeros(len(self.ids) + 1, dtype = bool)
+        is_parent[rows] = True
+        return is_parent[self.parent_rows]
+
+    def exons_and_cds_in_transcripts(self):
+        """Returns a mask of the exons and CDSs whose parent is a transcript"""
+        return (self.is_exon | self.is_cds) & self.children_mask(np.flatnonzero(self.is_transcript))
+
+    def orphans(self):
+        """Returns a mask of the features that are not attached to a gene: transcripts
+        whose parent is not in the dataframe and exons/CDSs whose parent is not a transcript"""
+        return (self.is_transcript & (self.parent_rows < 0)) | ((self.is_exon | self.is_cds) & ~self.exons_and_cds_in_transcripts())
+
+    def parent_gene_ids(self):
+        """Returns the ID of every feature's gene: the gene itself, a transcript's
+        Parent, or the Parent of an exon's/CDS's transcript. NaN for orphan
+        exons/CDSs and features of other types."""
+        parent_gene_ids = np.full(len(self.ids), np.nan, dtype = object)
+        parent_gene_ids[self.is_gene] = self.ids[self.is_gene]
+        parent_gene_ids[self.is_transcript] = self.parents[self.is_transcript]
+        in_transcript = self.exons_and_cds_in_transcripts()
+        parent_gene_ids[in_transcript] = self.parents[self.parent_rows[in_transcript]]
+        return parent_gene_ids
+
+
+# Returns the gene, transcript, exon and CDS features of a gff dataframe,
+# in that order, with a Parent_Gene column holding the ID of each
+# feature's gene. Used for sorting the final .gff. Exons/CDSs whose
+# parent is not a transcript are dropped, and they are grouped by
+# transcript in order of first appearance. A HIERARCHY already built for
+# gff_df can be passed in.
+def get_parent_gene_for_all(gff_df, hierarchy = None):
+    if hierarchy is None:
+        hierarchy = HIERARCHY(gff_df)
+
+    orphan_exons_cds = hierarchy.orphans() & (hierarchy.is_exon | hierarchy.is_cds)
+    if orphan_exons_cds.any():
+        print_warning(str(orphan_exons_cds.sum()) + " exon/CDS features are dropped as their parent is not a transcript, e.g.: " +
+                      ", ".join(str(feature_id) for feature_id in hierarchy.ids[orphan_exons_cds][:10]))
+
+    in_transcript = hierarchy.exons_and_cds_in_transcripts()
+    feature_rows = [np.flatnonzero(hierarchy.is_gene), np.flatnonzero(hierarchy.is_transcript)]
+    for is_exon_or_cds in [hierarchy.is_exon, hierarchy.is_cds]:
+        rows = np.flatnonzero(in_transcript & is_exon_or_cds)
+        transcript_order = pd.factorize(hierarchy.parent_rows[rows])[0]
+        feature_rows.append(rows[np.argsort(transcript_order, kind = "stable")])
+
+    feature_rows = np.concatenate(feature_rows)
+    reordered_gff = gff_df.take(feature_rows)
+    # The result gets a fresh index: datachecks drop features by index label.
+    reordered_gff.index = pd.RangeIndex(len(feature_rows))
+    reordered_gff["Parent_Gene"] = hierarchy.parent_gene_ids()[feature_rows]
 
     return(reordered_gff)
 
-
-# Creates Parent Gene column for all gene features. This contains the ID
-# the gene's own gene ID (quick copy). Used for sorting the final .gff.
-def _get_parent_gene_for_genes(gene_df):
-    # TODO: Still raises a chained assignment warning:
-    gene_df.loc[:,"Parent_Gene"] = gene_df["ID"]
-    return gene_df
-
-
-# Creates a Parent Gene column for all transcript features. This contains
-# the ID of the transcripts' parent gene (quick copy from Parent col).
-# Used for sorting the final .gff.
-def _get_parent_gene_for_transcripts(transcript_df):
-    # TODO: Still raises a chained assignment warning
-    transcript_df.loc[:,["Parent_Gene"]] = transcript_df["Parent"]
-    return transcript_df
-
-
-# Creates Parent Gene column for all exon or CDS features. This contains
-# the ID of the exon's/CDS's parent gene. It has to be inferred from its 
-# parent transcript, requiring iterrows instead of vectorised copying. 
-# Used for sorting the final .gff.
-def _get_parent_gene_for_exons_or_cds(exon_or_cds_df, transcript_df):
-    # TODO: May need dramatic speeding up due to reliance on iterrows.
-    exon_or_cds_df.reset_index(drop = True, inplace = True)
-    transcript_df.reset_index(drop = True, inplace = True)
-    exon_or_cds_tr_merged = exon_or_cds_df.merge(transcript_df[["ID","Parent"]], left_on="Parent", right_on="ID", suffixes=(None, "_transcript"))
-    exon_or_cds_tr_merged.rename(columns={'Parent_transcript': 'Parent_Gene'}, inplace=True)
-    exon_or_cds_tr_merged.drop(columns=['ID_transcript'])
-    return exon_or_cds_tr_merged
+# Inverted index of a .gff dataframe: from (attribute, value) to the rows
+# of the genes with that value, and from a gene ID to the rows of its
+# features (the gene, its transcripts and their exons/CDSs, by ID and
+# Parent_Gene). Each part is built on first use and then answers queries
+# in time proportional to their result, so one index can serve many
+# extract_genes_and_features_with_gene_attribute_value calls.
+class GENEINDEX:
+    def __init__(self, gff_df):
+        self.gff_df = gff_df
+        self.gene_rows = np.flatnonzero(gff_df["type"].isin(gene_types).values)
+        self._gene_rows_by_value = {}
+        self._feature_rows_by_gene = None
+
+    @staticmethod
+    def _group_rows(keys, rows):
+        """Groups rows by their keys (NaN excluded). Returns the unique keys as an
+        Index, the rows sorted by key and where each key's rows start in them"""
+        codes, unique_keys = pd.factorize(keys)
+        order = np.argsort(codes, kind = "stable")
+        group_starts = np.zeros(len(unique_keys) + 1, dtype = int)
+        np.cumsum(np.bincount(codes[codes >= 0], minlength = len(unique_keys)), out = group_starts[1:])
+        return pd.Index(unique_keys), rows[order][len(codes) - group_starts[-1]:], group_starts
+
+    @staticmethod
+    def _rows_with_keys(grouped_rows, keys):
+        """Returns the rows grouped (by _group_rows) under any of the given keys"""
+        unique_keys, sorted_rows, group_starts = grouped_rows
+        key_codes = unique_keys.get_indexer(keys)
+        key_codes = key_codes[key_codes >= 0]
+        starts = group_starts[key_codes]
+        lengths = group_starts[key_codes + 1] - starts
+        # Positions start, start + 1, ... of each group, in one go
+        positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return sorted_rows[positions]
+
+    def gene_rows_with_value(self, attribute, value):
+        """Returns the rows, in order, of the genes whose attribute is value"""
+        if attribute not in self.gff_df.columns:
+            return self.gene_rows[:0]
+        if attribute not in self._gene_rows_by_value:
+            self._gene_rows_by_value[attribute] = self._group_rows(self.gff_df[attribute].values[self.gene_rows], self.gene_rows)
+        return self._rows_with_keys(self._gene_rows_by_value[attribute], [value])
+
+    def feature_rows_of_genes(self, gene_ids):
+        """Returns the rows, in order, of the features with one of the given IDs or Parent_Genes"""
+        if self._feature_rows_by_gene is None:
+            if "Parent_Gene" in self.gff_df.columns:
+                parent_gene_ids = self.gff_df["Parent_Gene"].values
+            else:
+                parent_gene_ids = HIERARCHY(self.gff_df).parent_gene_ids()
+            # Features are keyed by Parent_Gene, and also by ID when that is the ID
+            # of another gene (the gene's own row has its ID as Parent_Gene)
+            ids = self.gff_df["ID"].values
+            all_gene_ids = pd.unique(ids[self.gene_rows])
+            other_gene_id_rows = np.flatnonzero(pd.Series(ids).isin(all_gene_ids).values & (ids != parent_gene_ids))
+            self._feature_rows_by_gene = self._group_rows(np.concatenate([parent_gene_ids, ids[other_gene_id_rows]]),
+                                                          np.concatenate([np.arange(len(ids)), other_gene_id_rows]))
+        return np.unique(self._rows_with_keys(self._feature_rows_by_gene, pd.unique(np.asarray(gene_ids, dtype = object))))
 
 # Gets a condition (or a semicolon-separated list of them) in the format of <attribute_field>=<something> like
 # gene_status=other and outputs the input gff without the features having the condition specified in their attributes
 # as well as their children features. It also outputs a separate gff with these filtered features.
-def extract_genes_and_features_with_gene_attribute_value(gff_df, attribute_condition_input):
+# A GENEINDEX of gff_df can be given to reuse across calls. Exits with an error if no feature has one
+# of the attributes, unless allow_missing_attributes is set (for parts of a .gff, see
+# gene_attribute_condition_fields), in which case nothing is extracted.
+def extract_genes_and_features_with_gene_attribute_value(gff_df, attribute_condition_input, gene_index = None,
+                                                         allow_missing_attributes = False):
 
     attribute_conditions = attribute_condition_input.split(';')
     attribute_conditions_dict = {attribute_field.split('=')[0].strip():attribute_field.split('=')[1].strip() for attribute_field in attribute_conditions}
 
-    query = ' & '.join(['{}=="{}"'.format(k, v) for k, v in attribute_conditions_dict.items()]) + ' & type == @gene_types'
-
-    extracted_genes = list(set(gff_df.query(query)['ID']))
-    mask_var = (gff_df['ID'].isin(extracted_genes)) | (gff_df['Parent_Gene'].isin(extracted_genes))
-    extracted_gff_df = gff_df[mask_var]
-    original_gff_df = gff_df[~mask_var]
+    missing_attribute_fields = [attribute_field for attribute_field in attribute_conditions_dict if attribute_field not in gff_df.columns]
+    if missing_attribute_fields:
+        if not allow_missing_attributes:
+            exit_with_error("No feature in the .gff has the attribute(s): " + ", ".join(missing_attribute_fields))
+        # No feature can match an attribute that no feature has.
+        return gff_df, gff_df.iloc[0:0]
+
+    if gene_index is None:
+        gene_index = GENEINDEX(gff_df)
+    gene_rows = None
+    for attribute_field, value in attribute_conditions_dict.items():
+        value_gene_rows = gene_index.gene_rows_with_value(attribute_field, value)
+        gene_rows = value_gene_rows if gene_rows is None else np.intersect1d(gene_rows, value_gene_rows, assume_unique = True)
+
+    extracted_rows = gene_index.feature_rows_of_genes(gff_df["ID"].values[gene_rows])
+    if len(extracted_rows) == 0:
+        return gff_df, gff_df.iloc[0:0]
+    original_mask = np.ones(len(gff_df), dtype = bool)
+    original_mask[extracted_rows] = False
+    extracted_gff_df = gff_df.take(extracted_rows)
+    original_gff_df = gff_df[original_mask]
 
     return original_gff_df, extracted_gff_df
 
+# Returns the attribute fields of a condition given to
+# extract_genes_and_features_with_gene_attribute_value
+def gene_attribute_condition_fields(attribute_condition_input):
+    return [attribute_field.split('=')[0].strip() for attribute_field in attribute_condition_input.split(';')]
+
 # Returns numpy array containing all unique type values in .gff
 def _get_all_unique_types(gff_df):
     return pd.unique(gff_df["type"])
@@ -481,55 +1063,206 @@ def _drop_useless_columns(gff_df):
     gff_df = gff_df.drop(columns=[column for column in gff_df if column not in useful_columns])
     return gff_df
 
+# Sort key putting names in natural order, e.g. chr2 before chr10. Split
+# on digit runs, names always alternate text, number, text...
+def natural_sort_key(name):
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', str(name))], str(name)
+
+# Returns the gene, transcript, exon and CDS features of a .gff dataframe
+# (as get_parent_gene_for_all) and, for each of them in output order, its
+# row and the number of its gene block. Gene blocks are ordered by scaffold
+# in natural order (or by their rank in scaffold_ranks, a dict of scaffold
+# name to rank, when given), then by start. A block is a gene followed by each of
+# its transcripts in start order, each transcript followed by its exons
+# and then its CDSs in start order. Transcripts without a gene make up a
+# block of their own.
+def _natural_feature_order(gff_df, scaffold_ranks = None):
+    gff_df = get_parent_gene_for_all(gff_df)
+    hierarchy = HIERARCHY(gff_df)
+    rows = np.arange(len(gff_df))
+    starts = gff_df["start"].values
+
+    scaffolds = gff_df["scaffold"].astype("category").cat
+    given_ranks = scaffold_ranks or {}
+    scaffold_key = lambda code: (given_ranks.get(scaffolds.categories[code], len(given_ranks)), natural_sort_key(scaffolds.categories[code]))
+    scaffold_ranks = np.empty(len(scaffolds.categories) + 1, dtype = np.int64)
+    scaffold_ranks[sorted(range(len(scaffolds.categories)), key = scaffold_key)] = np.arange(len(scaffolds.categories))
+    # Features without a scaffold (code -1) pick the extra last element.
+    scaffold_ranks[-1] = len(scaffolds.categories)
+    scaffold_ranks = scaffold_ranks[scaffolds.codes]
+
+    # Each block starts at its gene, or at its first feature if it has no gene.
+    block_codes, block_ids = pd.factorize(gff_df["Parent_Gene"].fillna(""))
+    block_heads = np.full(len(block_ids), -1)
+    found_blocks, first_rows = np.unique(block_codes, return_index = True)
+    block_heads[found_blocks] = first_rows
+    gene_rows = np.flatnonzero(hierarchy.is_gene)
+    block_heads[block_codes[gene_rows][::-1]] = gene_rows[::-1]
+    block_ranks = np.empty(len(block_ids), dtype = np.int64)
+    block_ranks[np.lexsort((block_heads, starts[block_heads], scaffold_ranks[block_heads]))] = np.arange(len(block_ids))
+    block_ranks = block_ranks[block_codes]
+
+    # Transcripts are ranked by start, genes come before them (-1) and
+    # exons/CDSs take the rank of their transcript.
+    transcript_rows = np.flatnonzero(hierarchy.is_transcript)
+    transcript_ranks = np.full(len(gff_df), -1, dtype = np.int64)
+    transcript_ranks[transcript_rows[np.lexsort((transcript_rows, starts[transcript_rows]))]] = np.arange(len(transcript_rows))
+    in_transcript = hierarchy.is_exon | hierarchy.is_cds
+    transcript_ranks[in_transcript] = transcript_ranks[hierarchy.parent_rows[in_transcript]]
+
+    levels = np.select([hierarchy.is_gene, hierarchy.is_transcript, hierarchy.is_exon], [0, 1, 2], 3)
+    order = np.lexsort((rows, starts, levels, transcript_ranks, block_ranks))
+    return gff_df, order, block_ranks[order]
+
 # Outputs a finalised .gff dataframe that contains only gene, transcript,
-# exon and CDS features. Orders the dataframe so that features exist in a
-# hierarchy: gene, gene's transcripts, transcript's exons/CDSs
+# exon and CDS features, ordered as written by write_output_gff.
 def reorder_gff_features(gff_df):
-    gff_df.set_index("ID", drop=False, inplace=True)
-
-    reordered_gff = get_parent_gene_for_all(gff_df)
-
-    reordered_gff["type"] = pd.Categorical(reordered_gff["type"], list((gene_types + transcript_types + ["exon", "CDS"])))
-
-    # TODO: Sort is purely alphabetic (e.g. g10 comes after g1, should be g2)
-    reordered_gff = reordered_gff.sort_values(by=["Parent_Gene", "type"])
-    return reordered_gff
+    gff_df, order, block_ranks = _natural_feature_order(gff_df)
+    return gff_df.take(order)
 
-# Class to handle genome's FASTA file
+# Class to handle genome's FASTA file. Scaffold names and lengths come from
+# the FASTA's .fai index when there is an up to date one. Otherwise the
+# FASTA (plain or gzipped) is scanned once: header lines are split for the
+# name and other lines are only measured, so no sequence is stored.
 class FASTA:
     def __init__(self, fasta_path):
         self.path = fasta_path
+        self._scaffold_lengths = None
+
     def scaffold_names(self):
-        """Returns a list with all the unique scaffold names of the gff dataframe"""
-        ids = []
-        for record in SeqIO.parse(self.path, "fasta"):
-            ids.append(record.id)
-        if len(ids)!=len(set(ids)):
-            sys.exit("There are non unique scaffold names in FASTA file: " + self.path)
-        return (ids)
-
-# Class tha performs datachecks on a gff dataframe
+        """Returns a list with all the unique scaffold names of the FASTA file"""
+        return list(self.scaffold_lengths())
+
+    def scaffold_lengths(self):
+        """Returns a dict with the length of each scaffold of the FASTA file, in file order"""
+        if self._scaffold_lengths is None:
+            fai_path = self.path + ".fai"
+            if os.path.isfile(fai_path) and os.path.getmtime(fai_path) >= os.path.getmtime(self.path):
+                scaffolds = self._read_fai(fai_path)
+            else:
+                scaffolds = self._scan_fasta()
+            ids = [scaffold_name for scaffold_name, scaffold_length in scaffolds]
+            if len(ids)!=len(set(ids)):
+                sys.exit("There are non unique scaffold names in FASTA file: " + self.path)
+            self._scaffold_lengths = dict(scaffolds)
+        return self._scaffold_lengths
+
+    def _read_fai(self, fai_path):
+        """Returns (name, length) for each scaffold listed in a .fai index"""
+        with open(fai_path) as fai_file:
+            return [(fields[0], int(fields[1])) for fields in (line.rstrip("\n").split("\t") for line in fai_file) if len(fields) > 1]
+
+    def _scan_fasta(self):
+        """Returns (name, length) for each scaffold of the FASTA file. As with SeqIO,
+        the name is the header up to the first whitespace, and line breaks and
+        spaces are not counted in the length. The file is read in blocks and
+        only searched and counted, never split into lines."""
+        with open(self.path, 'rb') as fasta_file:
+            is_gzipped = fasta_file.read(2) == b'\x1f\x8b'
+        scaffolds = []
+        header = None
+        at_line_start = True
+        with (gzip.open if is_gzipped else open)(self.path, 'rb') as fasta_file:
+            for block in iter(lambda: fasta_file.read(1 << 24), b''):
+                position = 0
+                while position < len(block):
+                    if header is not None:
+                        # Inside a header line, which may continue from the previous block
+                        header_end = block.find(b'\n', position)
+                        if header_end < 0:
+                            header += block[position:]
+                            position = len(block)
+                        else:
+                            scaffolds.append(self._scaffold_from_header(header + block[position:header_end]))
+                            header = None
+                            position = header_end + 1
+                    else:
+                        # Sequence lines, up to the next line starting with '>'
+                        line_start = at_line_start if position == 0 else block[position - 1] == ord('\n')
+                        if line_start and block.startswith(b'>', position):
+                            header_start = position
+                        else:
+                            header_start = block.find(b'\n>', position)
+                            header_start = len(block) if header_start < 0 else header_start + 1
+                        if scaffolds:
+                            scaffolds[-1][1] += header_start - position - sum(block.count(character, position, header_start) for character in (b'\n', b'\r', b' '))
+                        if header_start < len(block):
+                            header = b''
+                            position = header_start + 1
+                        else:
+                            position = header_start
+                at_line_start = block.endswith(b'\n')
+        if header is not None:
+            scaffolds.append(self._scaffold_from_header(header))
+        return [tuple(scaffold) for scaffold in scaffolds]
+
+    def _scaffold_from_header(self, header):
+        """Returns [name, 0] for a header line (without its '>')"""
+        header_fields = header.split(None, 1)
+        return [header_fields[0].decode() if header_fields else "", 0]
+
+# Class tha performs datachecks on a gff dataframe. If a reports dict is
+# given (scaffold by scaffold processing), offending scaffolds and
+# transcripts are collected in it across scaffolds, rather than reported
+# straight away, and are reported by report_collected_datachecks. With
+# threads > 1, the transcript datachecks look for offending transcripts
+# in that many processes, each given whole scaffolds.
 class DATACHECK:
-    def __init__(self, gff_df, fasta, args, outprefix=""):
+    def __init__(self, gff_df, fasta, args, outprefix="", reports=None, profiler=no_profiler, threads=1):
         self.gff_df = gff_df
         self.fasta = fasta
         self.args = args
         self.outprefix = outprefix
+        self.reports = reports
+        self.profiler = profiler
+        self.threads = threads
 
-    def perform_datachecks(self):
+    def _print_performing_datachecks(self):
         if self.args.dc_fasta_gff_scaffold or self.args.dc_cds_but_no_exons or self.args.dc_cds_within_exons:
             print_info("Performing DCs: " + ("for " + self.outprefix if self.outprefix!="" else ""))
-        self.genes_have_names()
+
+    def perform_datachecks(self):
+        if self.reports is None:
+            self._print_performing_datachecks()
+        with self.profiler.stage("dc_genes_have_names"):
+            self.genes_have_names()
         if self.args.dc_fasta_gff_scaffold:
-            self.gff_and_fasta_scaffold_names_match()
+            with self.profiler.stage("dc_gff_and_fasta_scaffold_names_match"):
+                if self.reports is None:
+                    self.gff_and_fasta_scaffold_names_match()
+                else:
+                    self.reports.setdefault("scaffolds", {}).update(dict.fromkeys(self.gff_df["scaffold"].unique()))
         if self.args.dc_cds_but_no_exons or self.args.dc_cds_within_exons:
-            self.transcripts_have_exons_and_valid_cds(dc_cds_but_no_exons=self.args.dc_cds_but_no_exons,
-                                                           dc_cds_but_no_exons_fix=self.args.dc_cds_but_no_exons_fix,
-                                                           dc_cds_within_exons=self.args.dc_cds_within_exons,
-                                                           dc_cds_within_exons_fix=self.args.dc_cds_within_exons_fix,
-                                                           dc_coding_transcripts_with_cds=self.args.dc_coding_transcripts_with_cds,
-                                                           dc_coding_transcripts_with_cds_fix=self.args.dc_coding_transcripts_with_cds_fix,
-                                                           prefix=self.outprefix)
+            with self.profiler.stage("dc_transcripts_have_exons_and_valid_cds"):
+                self.transcripts_have_exons_and_valid_cds(dc_cds_but_no_exons=self.args.dc_cds_but_no_exons,
+                                                               dc_cds_but_no_exons_fix=self.args.dc_cds_but_no_exons_fix,
+                                                               dc_cds_within_exons=self.args.dc_cds_within_exons,
+                                                               dc_cds_within_exons_fix=self.args.dc_cds_within_exons_fix,
+                                                               dc_coding_transcripts_with_cds=self.args.dc_coding_transcripts_with_cds,
+                                                               dc_coding_transcripts_with_cds_fix=self.args.dc_coding_transcripts_with_cds_fix,
+                                                               prefix=self.outprefix)
+
+    def report_collected_datachecks(self):
+        """Reports the scaffolds and transcripts collected by perform_datachecks over all
+        the scaffolds of a .gff, as perform_datachecks does for a whole .gff"""
+        self._print_performing_datachecks()
+        if self.args.dc_fasta_gff_scaffold:
+            with self.profiler.stage("dc_gff_and_fasta_scaffold_names_match"):
+                self.gff_and_fasta_scaffold_names_match(gff_scaffolds=list(self.reports.get("scaffolds", {})))
+        for report_file, (warning_message, offending_transcripts, fixed) in self.reports.get("transcripts", {}).items():
+            self._report_offending_transcripts(warning_message, sorted(offending_transcripts), report_file, fixed, collect=False)
+
+    def _report_offending_transcripts(self, warning_message, offending_transcripts, report_file, fixed, collect=True):
+        if collect and self.reports is not None:
+            report = self.reports.setdefault("transcripts", {}).setdefault(report_file, [warning_message, [], fixed])
+            report[1].extend(offending_transcripts)
+            return
+        print_warning(warning_message)
+        print("\n".join(offending_transcripts))
+        with open(report_file, mode='wt') as myfile:
+            myfile.write('\n'.join(offending_transcripts))
+        if fixed:
+            print_info("Changing the type of the offending transcripts to 'nontranslating_transcript'")
 
     def genes_have_names(self):
         # Filtering the DataFrame
@@ -539,13 +1272,17 @@ class DATACHECK:
             exit_with_error("Some/All genes do not have a Name column. Please add a Name column to your GFF file or use the --infer_gene_name/-n option.")
 
     
-    def gff_and_fasta_scaffold_names_match(self):
+    def gff_and_fasta_scaffold_names_match(self, gff_scaffolds=None):
         """Checks if the GFF's and FASTA file's scaffold names match"""
-        gff_scaffolds = list(self.gff_df["scaffold"].unique())
+        if gff_scaffolds is None:
+            gff_scaffolds = list(self.gff_df["scaffold"].unique())
         fasta_scaffolds = self.fasta.scaffold_names()
 
-        gff_to_fasta_discrepancies = [str(x) for x in gff_scaffolds if x not in fasta_scaffolds]
-        fasta_to_gff_discrepancies = [str(x) for x in fasta_scaffolds if x not in gff_scaffolds]
+        # Sets for the lookups, lists for the order of the reports
+        gff_scaffold_set = set(gff_scaffolds)
+        fasta_scaffold_set = set(fasta_scaffolds)
+        gff_to_fasta_discrepancies = [str(x) for x in gff_scaffolds if x not in fasta_scaffold_set]
+        fasta_to_gff_discrepancies = [str(x) for x in fasta_scaffolds if x not in gff_scaffold_set]
 
         if len(gff_to_fasta_discrepancies) > 0:
             with open(self.outprefix+'in_GFF_not_in_FASTA_scaffolds.txt', mode='wt') as myfile:
@@ -565,71 +1302,78 @@ class DATACHECK:
          options are selected, the script returns a dataframe with the offending transcripts' type
          set to 'nontranslating_transcript'."""
 
-        # Get a DF with all exons and CDS, group it by transcript and calculate useful metrics
-        coding_transcripts = list(self.gff_df[self.gff_df["type"].isin(coding_transcript_types)]["ID"].unique())
-        exons_cds_df = get_all_exon_and_cds_features(self.gff_df, transcripts=coding_transcripts)
-        counts_per_transcript_df = exons_cds_df.groupby('Parent').apply(_count_cds_exons_per_transcript)
-
-        # Datacheck
-        if dc_cds_but_no_exons:
-            dc1_offending_transcripts=counts_per_transcript_df[(counts_per_transcript_df['no_of_exons']==0) & (counts_per_transcript_df['no_of_cds']>0)].index.values.tolist()
-            if dc1_offending_transcripts:
-                print_warning("The following transcripts have CDS but they don't have exons. These transcripts "
-                              "will be written in cds_not_exons_transcripts.txt")
-                print("\n".join(dc1_offending_transcripts))
-                with open(prefix+'cds_not_exons_transcripts.txt', mode='wt') as myfile:
-                    myfile.write('\n'.join(dc1_offending_transcripts))
-                if dc_cds_but_no_exons_fix:
-                    print_info("Changing the type of the offending transcripts to 'nontranslating_transcript'")
-                    self.gff_df.loc[(self.gff_df['type'].isin(coding_transcript_types)) &
-                                    (self.gff_df['ID'].isin(dc1_offending_transcripts)) , 'type'] = "nontranslating_transcript"
-                    self.gff_df.drop(self.gff_df.loc[(self.gff_df['type'] == 'CDS') &
-                                                     (self.gff_df['Parent'].isin(dc1_offending_transcripts))].index, inplace=True)
-
-        # Datacheck
-        if dc_cds_within_exons:
-            dc2_offending_transcripts=counts_per_transcript_df[(counts_per_transcript_df['exons_max_coord'] < counts_per_transcript_df['cds_max_coord']) |
-                                                 (counts_per_transcript_df['exons_min_coord'] > counts_per_transcript_df['cds_min_coord'])].index.values.tolist()
-            if dc2_offending_transcripts:
-                print_warning("The following transcripts have CDS which are not within exon boundaries. These transcripts "
-                              "will be written in cds_not_within_exons_transcripts.txt")
-                print("\n".join(dc2_offending_transcripts))
-                with open(prefix+'cds_not_within_exons_transcripts.txt', mode='wt') as myfile:
-                    myfile.write('\n'.join(dc2_offending_transcripts))
-                if dc_cds_within_exons_fix:
-                    print_info("Changing the type of the offending transcripts to 'nontranslating_transcript'")
-                    self.gff_df.loc[(self.gff_df['type'].isin(coding_transcript_types)) &
-                                    (self.gff_df['ID'].isin(dc2_offending_transcripts)), 'type'] = "nontranslating_transcript"
-                    self.gff_df.drop(self.gff_df.loc[(self.gff_df['type'] == 'CDS') &
-                                                     (self.gff_df['Parent'].isin(dc2_offending_transcripts))].index, inplace=True)
-
-        # Datacheck
-        if dc_coding_transcripts_with_cds:
-            dc3_offending_transcripts=counts_per_transcript_df[counts_per_transcript_df['no_of_cds']==0].index.values.tolist()
-            if dc3_offending_transcripts:
-                print_warning("The following coding transcripts do not have CDS features. These transcripts "
-                              "will be written in without_CDS_transcripts.txt")
-                print("\n".join(dc3_offending_transcripts))
-                with open(prefix+'without_CDS_transcripts.txt', mode='wt') as myfile:
-                    myfile.write('\n'.join(dc3_offending_transcripts))
-                if dc_coding_transcripts_with_cds_fix:
-                    print_info("Changing the type of the offending transcripts to 'nontranslating_transcript'")
-                    self.gff_df.loc[(self.gff_df['type'].isin(coding_transcript_types)) &
-                                    (self.gff_df['ID'].isin(dc3_offending_transcripts)), 'type'] = "nontranslating_transcript"
-
-# Updates attributes field and drops unecessary columns, then writes
-# processed .gff to a specified output file.
-def write_output_gff(gff_df, output_file):
-    gff_df = finalise_attributes_column(gff_df)
-    gff_df = make_coding_transcripts_mRNA(gff_df)
-    gff_df = _drop_useless_columns(gff_df)
-    gff_df = reorder_gff_features(gff_df)
-    gff_df = _drop_superfluous_columns(gff_df)
-
-    with open(output_file, 'w') as output_gff:
-         output_gff.write("##gff-version 3\n")
-
-    gff_df.to_csv(output_file, mode = 'a', header = False, sep = '\t', index = False)
+        # Find the offending transcripts of each selected datacheck, per scaffold across
+        # processes if asked to, before any fix changes the dataframe
+        checks = {"cds_but_no_exons": (dc_cds_but_no_exons, dc_cds_but_no_exons_fix,
+                                       "The following transcripts have CDS but they don't have exons. These transcripts "
+                                       "will be written in cds_not_exons_transcripts.txt", 'cds_not_exons_transcripts.txt'),
+                  "cds_within_exons": (dc_cds_within_exons, dc_cds_within_exons_fix,
+                                       "The following transcripts have CDS which are not within exon boundaries. These transcripts "
+                                       "will be written in cds_not_within_exons_transcripts.txt", 'cds_not_within_exons_transcripts.txt'),
+                  "coding_transcripts_with_cds": (dc_coding_transcripts_with_cds, dc_coding_transcripts_with_cds_fix,
+                                                  "The following coding transcripts do not have CDS features. These transcripts "
+                                                  "will be written in without_CDS_transcripts.txt", 'without_CDS_transcripts.txt')}
+        checks = {check: check_args[1:] for check, check_args in checks.items() if check_args[0]}
+        if self.threads > 1 and self.gff_df["scaffold"].nunique() > 1:
+            offending_transcripts, offending_cds_rows = self._find_offending_transcripts_in_parallel(list(checks))
+        else:
+            offending_transcripts, offending_cds_rows = _find_offending_transcripts(self.gff_df, list(checks))
+        offending_cds = {check: self.gff_df.index[cds_rows] for check, cds_rows in offending_cds_rows.items()}
+
+        # Report and fix
+        for check, (fix, warning_message, report_file) in checks.items():
+            check_offending_transcripts = offending_transcripts[check]
+            if not check_offending_transcripts:
+                continue
+            self._report_offending_transcripts(warning_message, check_offending_transcripts, prefix+report_file, fix)
+            if fix:
+                _set_column_value(self.gff_df, (self.gff_df['type'].isin(coding_transcript_types)) &
+                                  (self.gff_df['ID'].isin(check_offending_transcripts)), 'type', "nontranslating_transcript")
+                if check in offending_cds:
+                    # Those not dropped already by a previous fix
+                    self.gff_df.drop(offending_cds[check].intersection(self.gff_df.index), inplace=True)
+
+    def _find_offending_transcripts_in_parallel(self, checks):
+        """_find_offending_transcripts over groups of whole scaffolds in self.threads
+        processes, with each check's transcripts and CDS rows merged in the same
+        (sorted) order as a single process would give"""
+        rows, row_ranges = _scaffold_row_ranges(self.gff_df, self.threads)
+        _datacheck_worker_state.update(gff_df=self.gff_df, rows=rows, checks=checks)
+        try:
+            with ProcessPoolExecutor(max_workers=min(self.threads, len(row_ranges)),
+                                     mp_context=multiprocessing.get_context("fork")) as pool:
+                results = list(pool.map(_find_offending_transcripts_in_rows, row_ranges))
+        finally:
+            _datacheck_worker_state.clear()
+        offending_transcripts = {check: sorted(transcript for transcripts, _ in results for transcript in transcripts[check]) for check in checks}
+        offending_cds_rows = {check: np.sort(np.concatenate([cds_rows[check] for _, cds_rows in results]))
+                              for check in checks if check in _cds_dropping_checks}
+        return offending_transcripts, offending_cds_rows
+
+# Writes a .gff dataframe to a .gff file (or appends it, without the
+# header) in the order given by _natural_feature_order. Gene blocks are
+# written blocks_per_chunk at a time, and the attributes column is only
+# built for the chunk being written. scaffold_ranks, if given, orders the
+# scaffolds instead of their natural order (see _natural_feature_order).
+def write_output_gff(gff_df, output_file, append = False, profiler = no_profiler, blocks_per_chunk = 10000, scaffold_ranks = None):
+    with open(output_file, 'a' if append else 'w') as output_gff:
+        if not append:
+            output_gff.write("##gff-version 3\n")
+        if gff_df.empty:
+            return
+
+        with profiler.stage("reorder_gff_features"):
+            gff_df = make_coding_transcripts_mRNA(gff_df)
+            gff_df = _drop_useless_columns(gff_df)
+            gff_df, order, block_ranks = _natural_feature_order(gff_df, scaffold_ranks)
+
+        with profiler.stage("write_gff"):
+            chunk_start = 0
+            while chunk_start < len(order):
+                chunk_end = np.searchsorted(block_ranks, block_ranks[chunk_start] + blocks_per_chunk)
+                chunk_df = finalise_attributes_column(gff_df.take(order[chunk_start:chunk_end]))
+                _drop_superfluous_columns(chunk_df).to_csv(output_gff, header = False, sep = '\t', index = False)
+                chunk_start = chunk_end
 
 # Unused functions that might inspire us in the future
 # def link_exons_and_cds_features(gff_df):
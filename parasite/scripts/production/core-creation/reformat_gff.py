@@ -3,6 +3,7 @@ from gff_utils import *
 from Bio import SeqIO
 from reformat_gff_dependencies import *
 from ProductionUtils import *
+import os
 import re
 import sys
 import glob
@@ -70,6 +71,28 @@ def get_args():
     parser.add_argument("--split_gff_when_gene_attribute", required = False, default = None, type = str,
         help = "Condition to split the input gff on in this format <attribute_field>=<something> for example gene_status=other. For multiple filters use a semicolon separated list.")
 
+    parser.add_argument("--by_scaffold", default = False, action = "store_true",
+        help = "Process the .gff a batch of scaffolds at a time (see --batch_size_mb), so that memory use follows the largest batch rather than the whole annotation. "
+               "Features are written grouped by scaffold, in the order scaffolds first appear in the input .gff. Needs an uncompressed .gff.")
+    parser.add_argument("--batch_size_mb", required = False, default = 8, type = float,
+        help = "With --by_scaffold, process consecutive scaffolds together, in batches of up to this many MB of .gff text "
+               "(a larger scaffold is a batch of its own). Default: 8.")
+
+    # use_gff_cache is set to True by default.
+    parser.add_argument("--no_gff_cache", action = "store_false", dest = "use_gff_cache",
+        help = "Do not cache the parsed .gff. By default, the parsed .gff is cached as a Feather file (needs pyarrow) named after the "
+               "input's checksum and reused by later runs on the same input. Not used with --by_scaffold.")
+    parser.add_argument("--gff_cache_dir", required = False, default = None, type = str,
+        help = "Directory for the parsed .gff cache. By default, the directory of the input .gff.")
+
+    parser.add_argument("--profile", default = False, action = "store_true",
+        help = "Record the wall time, CPU time and peak memory growth of each processing step and datacheck, and write them "
+               "to <output_gff>.profile.tsv and <output_gff>.profile.json.")
+
+    parser.add_argument("--threads", required = False, default = 1, type = int,
+        help = "Number of processes for the transcript datachecks, each checking a share of the scaffolds. The reports are the same "
+               "as with a single process (the default). Not used with --by_scaffold.")
+
     # Datachecks
     parser.add_argument("--no_gff_fasta_scaffold_match_dc", action="store_false", dest="dc_fasta_gff_scaffold",
                         help="Do not perform the DataCheck that compares the scaffolds between the gff and fasta. By default, it is implemented."
@@ -128,91 +151,269 @@ def infer_synonyms_file():
     return synonyms_file
 
 
-def main():
-    # Grab command-line arguments.
-    args = get_args()
+# Log function for scaffolds after the first one when processing scaffold
+# by scaffold, so that each step is only announced once.
+def _no_log(message):
+    pass
 
-    input_gff = args.input_gff
-    output_gff = args.output_gff
 
-    # If no .fasta file has been provided, infer one from directory.
-    if args.fasta is None:
-        fasta_path = infer_fasta_file()
-    else:
-        fasta_path = args.fasta
-    print_info("FASTA file: "+fasta_path)
+# Checks used to skip the steps of transform_gff that have nothing to
+# change. Each is at most one vectorised pass over a column.
+def _sources_are_wormbase(gff_df):
+    return gff_df["source"].notna().all() and set(gff_df["source"].unique()) == {wormbase_source}
 
-    fasta = FASTA(fasta_path)
+def _names_are_ids(gff_df):
+    return "Name" in gff_df.columns and gff_df["Name"].equals(gff_df["ID"])
+
+def _scaffolds_are_in_fasta(fasta):
+    return lambda gff_df: set(gff_df["scaffold"].unique()) <= set(fasta.scaffold_names())
 
-    gff_df = parse_gff(input_gff)
+def _scaffold_is_absent(scaffold):
+    return lambda gff_df: not (gff_df["scaffold"] == scaffold).any()
 
+
+# Builds the graph of transformations requested by the options (see
+# STEPGRAPH), up to and including getting the parent gene of all
+# features. When processing scaffold by scaffold, scaffold_map gives the
+# new name of every scaffold (worked out once for the whole .gff) instead
+# of the synonyms file. With a FASTA, scaffolds are only renamed if some
+# are not FASTA scaffold names.
+def transform_steps(args, synonyms_file = None, scaffold_map = None, fasta = None):
+    steps = STEPGRAPH()
     if args.source_to_WB is True:
-        print_info("Switching gff source to : " + wormbase_source)
-        gff_df = rename_sources(gff_df, new_source = wormbase_source)
+        steps.add(STEP("rename_sources", lambda gff_df: rename_sources(gff_df, new_source = wormbase_source),
+                       inputs = [], outputs = ["source"], is_clean = _sources_are_wormbase,
+                       message = "Switching gff source to : " + wormbase_source))
 
     if args.overwrite_gene_names is True:
-        print_info("Inferring and overwriting gene names (Name=) from the ID field (ID=).")
-        gff_df = infer_and_overwrite_name_attribute_from_id(gff_df)
+        steps.add(STEP("infer_gene_names", infer_and_overwrite_name_attribute_from_id,
+                       inputs = ["ID"], outputs = ["Name"], is_clean = _names_are_ids,
+                       message = "Inferring and overwriting gene names (Name=) from the ID field (ID=)."))
     elif args.infer_gene_names is True:
-        print_info("Inferring gene names (Name=) from the ID attribute field (ID=).")
-        gff_df = infer_name_attribute_from_id(gff_df)
+        steps.add(STEP("infer_gene_names", infer_name_attribute_from_id,
+                       inputs = ["ID", "Name"], outputs = ["Name"], is_clean = _names_are_ids,
+                       message = "Inferring gene names (Name=) from the ID attribute field (ID=)."))
 
     if args.gene_prefix:
-        print_info("Adding the "+args.gene_prefix+" to gene Name and ID attribute fields.")
-        gff_df = add_prefix_to_id(gff_df, prefix = args.gene_prefix)
-        gff_df = add_prefix_to_name(gff_df, prefix = args.gene_prefix)
+        steps.add(STEP("add_gene_prefix", lambda gff_df: add_prefix_to_name(add_prefix_to_id(gff_df, prefix = args.gene_prefix), prefix = args.gene_prefix),
+                       inputs = ["ID", "Name"], outputs = ["ID", "Name"],
+                       message = "Adding the "+args.gene_prefix+" to gene Name and ID attribute fields."))
 
     if args.scaffold_rename:
-        # If no synonyms.tsv file has been provided, infer one from directory.
-        if args.synonyms_file is None:
-            synonyms_file = infer_synonyms_file()
+        if scaffold_map is None:
+            rename = lambda gff_df: rename_scaffolds(gff_df, synonyms_file)
         else:
-            synonyms_file = args.synonyms_file
-        print_info("SYNONYMS file: " + synonyms_file)
-        print_info("Renaming GFF scaffolds.")
-        gff_df = rename_scaffolds(gff_df, synonyms_file)
-
+            def rename(gff_df):
+                gff_df["scaffold"] = gff_df["scaffold"].map(scaffold_map).astype("category")
+                return gff_df
+        steps.add(STEP("rename_scaffolds", rename, inputs = ["scaffold"], outputs = ["scaffold"],
+                       is_clean = _scaffolds_are_in_fasta(fasta) if fasta is not None else None,
+                       message = "Renaming GFF scaffolds."))
 
     if args.prefixes is not None:
-        print_info("Removing prefixes ("+", ".join(args.prefixes)+") from all the fields of the gff file")
-        gff_df = remove_prefixes_from_column_values(gff_df, args.prefixes)
+        steps.add(STEP("remove_prefixes", lambda gff_df: remove_prefixes_from_column_values(gff_df, args.prefixes),
+                       inputs = id_gff_columns, outputs = id_gff_columns,
+                       is_clean = lambda gff_df: not has_prefixes(gff_df, args.prefixes),
+                       message = "Removing prefixes ("+", ".join(args.prefixes)+") from the scaffold and ID fields (" + ", ".join(id_gff_columns) + ") of the gff file"))
 
     if args.name_prefixes is not None:
-        print_info("Removing prefixes ("+", ".join(args.name_prefixes)+") from the Name= field")
-        gff_df = remove_prefixes_from_name_column(gff_df, args.name_prefixes)
-
+        steps.add(STEP("remove_name_prefixes", lambda gff_df: remove_prefixes_from_name_column(gff_df, args.name_prefixes),
+                       inputs = ["Name"], outputs = ["Name"],
+                       is_clean = lambda gff_df: not has_prefixes(gff_df, args.name_prefixes, columns = ["Name"]),
+                       message = "Removing prefixes ("+", ".join(args.name_prefixes)+") from the Name= field"))
+
+    # Extrapolations add features by concatenation, so the index is reset
+    # for the datachecks, which drop features by index label.
+    extrapolated_columns = ["features", "type", "ID", "Name", "Parent"]
     if args.extrapolate_transcripts_for_scaffold is not None:
-        print_info("Extrapolating transcripts from genes for scaffold: "+args.extrapolate_transcripts_for_scaffold)
-        gff_df = extrapolate_scaffold_transcripts_from_genes(gff_df, args.extrapolate_transcripts_for_scaffold)
+        scaffold = args.extrapolate_transcripts_for_scaffold
+        steps.add(STEP("extrapolate_genes_or_transcripts",
+                       lambda gff_df, scaffold = scaffold: extrapolate_scaffold_transcripts_from_genes(gff_df, scaffold).reset_index(drop = True),
+                       inputs = ["scaffold"] + extrapolated_columns, outputs = extrapolated_columns, is_clean = _scaffold_is_absent(scaffold),
+                       message = "Extrapolating transcripts from genes for scaffold: " + scaffold))
     elif args.extrapolate_genes_for_scaffold is not None:
-        print_info("Extrapolating genes from transcripts for scaffold: " + args.extrapolate_genes_for_scaffold)
-        gff_df = extrapolate_scaffold_genes_from_transcripts(gff_df, args.extrapolate_transcripts_for_scaffold)
+        scaffold = args.extrapolate_genes_for_scaffold
+        steps.add(STEP("extrapolate_genes_or_transcripts",
+                       lambda gff_df, scaffold = scaffold: extrapolate_scaffold_genes_from_transcripts(gff_df, scaffold).reset_index(drop = True),
+                       inputs = ["scaffold"] + extrapolated_columns, outputs = extrapolated_columns, is_clean = _scaffold_is_absent(scaffold),
+                       message = "Extrapolating genes from transcripts for scaffold: " + scaffold))
 
     if args.extrapolate_exons_for_scaffold is not None:
-        print_info("Extrapolating exons from CDSs for scaffold: " + args.extrapolate_exons_for_scaffold)
-        gff_df = extrapolate_scaffold_exons_from_cds(gff_df, args.extrapolate_exons_for_scaffold)
+        scaffold = args.extrapolate_exons_for_scaffold
+        steps.add(STEP("extrapolate_exons_or_cds",
+                       lambda gff_df, scaffold = scaffold: extrapolate_scaffold_exons_from_cds(gff_df, scaffold).reset_index(drop = True),
+                       inputs = ["scaffold"] + extrapolated_columns, outputs = extrapolated_columns, is_clean = _scaffold_is_absent(scaffold),
+                       message = "Extrapolating exons from CDSs for scaffold: " + scaffold))
     elif args.extrapolate_CDSs_for_scaffold is not None:
-        print_info("Extrapolating CDSs from exons for scaffold: " + args.extrapolate_CDSs_for_scaffold)
-        gff_df = extrapolate_scaffold_cds_from_exons(gff_df, args.extrapolate_CDSs_for_scaffold)
-
-    print_info("Getting Parent Gene for all features ")
-    gff_df = get_parent_gene_for_all(gff_df)
+        scaffold = args.extrapolate_CDSs_for_scaffold
+        steps.add(STEP("extrapolate_exons_or_cds",
+                       lambda gff_df, scaffold = scaffold: extrapolate_scaffold_cds_from_exons(gff_df, scaffold).reset_index(drop = True),
+                       inputs = ["scaffold"] + extrapolated_columns, outputs = extrapolated_columns, is_clean = _scaffold_is_absent(scaffold),
+                       message = "Extrapolating CDSs from exons for scaffold: " + scaffold))
+
+    # Also keeps only genes, transcripts and their exons/CDSs: the features
+    # that are written, and so the ones the datachecks must see.
+    steps.add(STEP("get_parent_gene_for_all", get_parent_gene_for_all,
+                   inputs = ["features", "type", "ID", "Parent"], outputs = ["features", "Parent_Gene"],
+                   message = "Getting Parent Gene for all features "))
+    return steps
+
+
+# Applies the requested transformations to a parsed .gff dataframe (see
+# transform_steps). Steps with nothing to change are skipped.
+def transform_gff(gff_df, args, synonyms_file = None, scaffold_map = None, fasta = None, log = print_info, profiler = no_profiler):
+    # Features and columns used by the datachecks and written to the output .gff
+    targets = ["features", "scaffold", "source", "type", "start", "end", "score", "strand", "phase", "ID", "Name", "Parent"]
+    steps = transform_steps(args, synonyms_file = synonyms_file, scaffold_map = scaffold_map, fasta = fasta)
+    return steps.run(gff_df, targets, log = log, profiler = profiler)
+
+
+# Runs all the steps on the whole .gff at once.
+def reformat_gff(input_gff, output_gff, fasta, args, synonyms_file, profiler = no_profiler):
+    with profiler.stage("parse_gff"):
+        if args.use_gff_cache:
+            gff_df = parse_gff_cached(input_gff, args.gff_cache_dir)
+        else:
+            gff_df = parse_gff(input_gff)
 
+    gff_df = transform_gff(gff_df, args, synonyms_file = synonyms_file, fasta = fasta, profiler = profiler)
 
     if args.split_gff_when_gene_attribute:
         print_info("Splitting GFF based on the gene attribute field(s): " + " & ".join(args.split_gff_when_gene_attribute.split(";")))
-        gff_df, extracted_gff_df = extract_genes_and_features_with_gene_attribute_value(gff_df, args.split_gff_when_gene_attribute)
-        extracted_datacheck = DATACHECK(extracted_gff_df, fasta, args, outprefix="extracted_")
-        extracted_datacheck.perform_datachecks()
+        with profiler.stage("split_gff"):
+            gff_df, extracted_gff_df = extract_genes_and_features_with_gene_attribute_value(gff_df, args.split_gff_when_gene_attribute)
+        extracted_datacheck = DATACHECK(extracted_gff_df, fasta, args, outprefix="extracted_", profiler=profiler, threads=args.threads)
+        with profiler.stage("datachecks"):
+            extracted_datacheck.perform_datachecks()
         extracted_output_gff = "extracted.gff3"
-        write_output_gff(extracted_gff_df, extracted_output_gff)
+        write_output_gff(extracted_gff_df, extracted_output_gff, profiler = profiler)
 
     print_info("Running Datachecks")
-    datacheck = DATACHECK(gff_df, fasta, args)
-    datacheck.perform_datachecks()
+    datacheck = DATACHECK(gff_df, fasta, args, profiler=profiler, threads=args.threads)
+    with profiler.stage("datachecks"):
+        datacheck.perform_datachecks()
+
+    write_output_gff(gff_df, output_gff, profiler = profiler)
+
+
+
+# Runs the same steps as reformat_gff() on batches of consecutive scaffolds
+# (see batch_gff_scaffolds), so that only one batch's features are held in
+# memory. Scaffold renaming is worked out once from the scaffold names,
+# and the scaffold name datacheck and the offending transcript reports
+# are collected across batches and run at the end. Outputs are written to .part files and only moved into place
+# once all datachecks have passed.
+def reformat_gff_by_scaffold(input_gff, output_gff, fasta, args, synonyms_file, profiler = no_profiler):
+    with profiler.stage("index_gff_scaffolds"):
+        scaffold_ranges = index_gff_scaffolds(input_gff)
+
+    scaffold_map = None
+    if args.scaffold_rename:
+        scaffold_names_df = pd.DataFrame({"scaffold": list(scaffold_ranges)})
+        renamed_scaffold_names_df = rename_scaffolds(scaffold_names_df, synonyms_file)
+        scaffold_map = dict(zip(scaffold_names_df["scaffold"], renamed_scaffold_names_df["scaffold"]))
+    # Scaffolds are written in order of first appearance, under their
+    # original or new name (renaming is skipped if there is nothing to change).
+    scaffold_ranks = {}
+    for rank, scaffold in enumerate(scaffold_ranges):
+        scaffold_ranks.setdefault(scaffold, rank)
+        if scaffold_map is not None:
+            scaffold_ranks.setdefault(scaffold_map[scaffold], rank)
+
+    output_part = output_gff + ".part"
+    write_output_gff(pd.DataFrame(columns = ["scaffold", "ID", "Name", "Parent", "type"]), output_part)
+    reports = {}
+
+    extracted_output_gff = "extracted.gff3"
+    extracted_output_part = extracted_output_gff + ".part"
+    extracted_reports = {}
+    # Attributes of the split condition that some batch has: a batch may
+    # lack one, but the whole .gff must have them all.
+    split_attribute_fields = set()
+    if args.split_gff_when_gene_attribute:
+        write_output_gff(pd.DataFrame(columns = ["scaffold", "ID", "Name", "Parent", "type"]), extracted_output_part)
+
+    seen_id_counts = {}
+    log = print_info
+    for ranges in batch_gff_scaffolds(scaffold_ranges, args.batch_size_mb * 1024 * 1024):
+        with profiler.stage("parse_gff"):
+            gff_df = parse_gff_scaffold(input_gff, ranges, seen_id_counts)
+        gff_df = transform_gff(gff_df, args, scaffold_map = scaffold_map, fasta = fasta, log = log, profiler = profiler)
+
+        if args.split_gff_when_gene_attribute:
+            log("Splitting GFF based on the gene attribute field(s): " + " & ".join(args.split_gff_when_gene_attribute.split(";")))
+            with profiler.stage("split_gff"):
+                gff_df, extracted_gff_df = extract_genes_and_features_with_gene_attribute_value(gff_df, args.split_gff_when_gene_attribute,
+                                                                                                 allow_missing_attributes = True)
+            split_attribute_fields.update(gff_df.columns.intersection(gene_attribute_condition_fields(args.split_gff_when_gene_attribute)))
+            if not extracted_gff_df.empty:
+                extracted_datacheck = DATACHECK(extracted_gff_df, fasta, args, outprefix="extracted_", reports=extracted_reports, profiler=profiler)
+                with profiler.stage("datachecks"):
+                    extracted_datacheck.perform_datachecks()
+                write_output_gff(extracted_gff_df, extracted_output_part, append = True, profiler = profiler, scaffold_ranks = scaffold_ranks)
+
+        log("Running Datachecks")
+        if not gff_df.empty:
+            datacheck = DATACHECK(gff_df, fasta, args, reports=reports, profiler=profiler)
+            with profiler.stage("datachecks"):
+                datacheck.perform_datachecks()
+            write_output_gff(gff_df, output_part, append = True, profiler = profiler, scaffold_ranks = scaffold_ranks)
+
+        log = _no_log
+
+    if args.split_gff_when_gene_attribute:
+        missing_attribute_fields = [attribute_field for attribute_field in gene_attribute_condition_fields(args.split_gff_when_gene_attribute)
+                                    if attribute_field not in split_attribute_fields]
+        if missing_attribute_fields:
+            exit_with_error("No feature in the .gff has the attribute(s): " + ", ".join(missing_attribute_fields))
+
+    with profiler.stage("datachecks"):
+        if args.split_gff_when_gene_attribute:
+            DATACHECK(None, fasta, args, outprefix="extracted_", reports=extracted_reports, profiler=profiler).report_collected_datachecks()
+            os.replace(extracted_output_part, extracted_output_gff)
+
+        DATACHECK(None, fasta, args, reports=reports, profiler=profiler).report_collected_datachecks()
+    os.replace(output_part, output_gff)
+
+
+def main():
+    # Grab command-line arguments.
+    args = get_args()
+
+    input_gff = args.input_gff
+    output_gff = args.output_gff
+
+    # If no .fasta file has been provided, infer one from directory.
+    if args.fasta is None:
+        fasta_path = infer_fasta_file()
+    else:
+        fasta_path = args.fasta
+    print_info("FASTA file: "+fasta_path)
+
+    fasta = FASTA(fasta_path)
+
+    synonyms_file = None
+    if args.scaffold_rename:
+        # If no synonyms.tsv file has been provided, infer one from directory.
+        if args.synonyms_file is None:
+            synonyms_file = infer_synonyms_file()
+        else:
+            synonyms_file = args.synonyms_file
+        print_info("SYNONYMS file: " + synonyms_file)
+
+    if args.threads < 1:
+        exit_with_error("--threads must be at least 1")
+
+    profiler = PROFILER(enabled = args.profile)
+
+    if args.by_scaffold:
+        reformat_gff_by_scaffold(input_gff, output_gff, fasta, args, synonyms_file, profiler = profiler)
+    else:
+        reformat_gff(input_gff, output_gff, fasta, args, synonyms_file, profiler = profiler)
 
-    write_output_gff(gff_df, output_gff)
+    if args.profile:
+        profiler.write_reports(output_gff + ".profile")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,180 @@
+#!/hps/software/users/wormbase/parasite/shared/.pyenv/versions/p395/bin/python
+from ProductionUtils import *
+import os
+import random
+from argparse import ArgumentParser
+
+
+# Prefixes of the IDs of each feature type, as in NCBI .gff files
+id_prefixes = {"gene": "gene-", "transcript": "rna-", "exon": "exon-", "CDS": "cds-"}
+# Prefixes that some genes' IDs and Names also get, as left by MAKER runs
+noise_prefixes = ["maker-", "augustus_masked-", "snap_masked-"]
+
+
+# Adds the options of the synthetic annotation to an ArgumentParser
+# (shared with benchmark_gff_tools.py).
+def add_synthetic_gff_arguments(parser):
+    parser.add_argument("--genes", default = 10000, type = int,
+        help = "Number of genes. Default: 10000.")
+    parser.add_argument("--scaffolds", default = 50, type = int,
+        help = "Number of scaffolds. Genes are spread over them unevenly, as in a real assembly. Default: 50.")
+    parser.add_argument("--isoforms", default = 3, type = int,
+        help = "Maximum number of transcripts per gene. Default: 3.")
+    parser.add_argument("--duplicate_id_rate", default = 0.1, type = float,
+        help = "Fraction of genes whose transcripts share the IDs of their exons. Default: 0.1.")
+    parser.add_argument("--missing_parent_rate", default = 0.01, type = float,
+        help = "Fraction of transcripts left out of the .gff, so that their exons and CDSs have a missing Parent. Default: 0.01.")
+    parser.add_argument("--prefix_noise_rate", default = 0.1, type = float,
+        help = "Fraction of genes whose IDs and Names start with one of " + ", ".join(noise_prefixes) + ". Default: 0.1.")
+    parser.add_argument("--shuffle", default = False, action = "store_true",
+        help = "Write the features in random order rather than sorted by position.")
+    parser.add_argument("--seed", default = 1, type = int,
+        help = "Seed of the random generator. The same options and seed give the same files. Default: 1.")
+
+
+# Grabs and returns command line arguments.
+def get_args():
+    parser = ArgumentParser(description = "Writes a synthetic GFF3 annotation with a matching FASTA and seq region "
+                                          "synonyms file, to test and benchmark the core creation .gff tools.")
+    parser.add_argument("output_prefix",
+        help = "Writes <output_prefix>.gff3, <output_prefix>.fa and <output_prefix>_synonyms.tsv.")
+    add_synthetic_gff_arguments(parser)
+    return parser.parse_args()
+
+
+# Names of the scaffolds: INSDC accessions, used in the .gff and the
+# FASTA as in NCBI downloads, and the community names they map to in
+# the seq region synonyms file.
+def _scaffold_names(scaffolds):
+    return [("SYNT%08d.1" % scaffold, "scaffold_%d" % (scaffold + 1)) for scaffold in range(scaffolds)]
+
+
+# Returns the exons of a gene as (start, end) pairs, from its start.
+def _gene_exons(rng, start):
+    exons = []
+    position = start
+    for exon in range(rng.randint(1, 10)):
+        end = position + rng.randint(50, 500)
+        exons.append((position, end))
+        position = end + rng.randint(50, 2000)
+    return exons
+
+
+# Returns the CDS segments of a transcript's exons as (start, end, phase),
+# in position order. The CDS starts and ends inside the outer exons, and
+# phases follow the strand.
+def _transcript_cds(rng, exons, strand):
+    segments = [list(exon) for exon in exons]
+    segments[0][0] += rng.randint(0, (segments[0][1] - segments[0][0]) // 3)
+    segments[-1][1] -= rng.randint(0, (segments[-1][1] - segments[-1][0]) // 3)
+    phases = {}
+    coding_length = 0
+    for segment in (segments if strand == "+" else reversed(segments)):
+        phases[segment[0]] = (3 - coding_length % 3) % 3
+        coding_length += segment[1] - segment[0] + 1
+    return [(start, end, phases[start]) for start, end in segments]
+
+
+# Returns the .gff lines of a gene, its transcripts, exons and CDSs.
+def _gene_lines(rng, args, scaffold, gene_number, start):
+    strand = rng.choice("+-")
+    gene_name = "SYN_g%d" % gene_number
+    if rng.random() < args.prefix_noise_rate:
+        gene_name = rng.choice(noise_prefixes) + gene_name
+    gene_id = id_prefixes["gene"] + gene_name
+    shared_exon_ids = rng.random() < args.duplicate_id_rate
+    transcript_type = rng.choices(["mRNA", "tRNA", "transcript"], weights = [90, 5, 5])[0]
+
+    gene_exons = _gene_exons(rng, start)
+    transcript_lines = []
+    for isoform in range(1, rng.randint(1, args.isoforms) + 1):
+        # Isoforms skip one of the inner exons
+        exons = list(gene_exons)
+        if isoform > 1 and len(exons) > 2:
+            del exons[rng.randrange(1, len(exons) - 1)]
+        transcript_name = "%s.t%d" % (gene_name, isoform)
+        transcript_id = id_prefixes["transcript"] + transcript_name
+        if rng.random() >= args.missing_parent_rate:
+            transcript_lines.append([scaffold, "RefSeq", transcript_type, exons[0][0], exons[-1][1], ".", strand, ".",
+                                     "ID=%s;Parent=%s;Name=%s" % (transcript_id, gene_id, transcript_name)])
+        for exon_number, (exon_start, exon_end) in enumerate(exons, 1):
+            exon_id = "%s%s-%d" % (id_prefixes["exon"], gene_name if shared_exon_ids else transcript_name, exon_number)
+            transcript_lines.append([scaffold, "RefSeq", "exon", exon_start, exon_end, ".", strand, ".",
+                                     "ID=%s;Parent=%s" % (exon_id, transcript_id)])
+        if transcript_type == "mRNA":
+            # One ID for all the CDS segments of a protein, as in NCBI .gff files
+            cds_id = id_prefixes["CDS"] + transcript_name.replace(".t", ".p")
+            for cds_start, cds_end, phase in _transcript_cds(rng, exons, strand):
+                transcript_lines.append([scaffold, "RefSeq", "CDS", cds_start, cds_end, ".", strand, phase,
+                                         "ID=%s;Parent=%s" % (cds_id, transcript_id)])
+    gene_line = [scaffold, "RefSeq", "gene", start, gene_exons[-1][1], ".", strand, ".",
+                 "ID=%s;Name=%s;gene_biotype=%s" % (gene_id, gene_name, "protein_coding" if transcript_type == "mRNA" else "ncRNA")]
+    return [gene_line] + transcript_lines
+
+
+# Writes a synthetic annotation as described by args (see
+# add_synthetic_gff_arguments) to <output_prefix>.gff3, with the FASTA of
+# its scaffolds in <output_prefix>.fa and the seq region synonyms that
+# rename them in <output_prefix>_synonyms.tsv. Returns the three paths.
+def write_synthetic_gff(output_prefix, args):
+    rng = random.Random(args.seed)
+    scaffolds = _scaffold_names(args.scaffolds)
+    # Genes spread over the scaffolds as 1/rank, so that there are a few
+    # large scaffolds and many small ones.
+    gene_scaffolds = rng.choices(range(len(scaffolds)), weights = [1 / (rank + 1) for rank in range(len(scaffolds))], k = args.genes)
+    scaffold_ends = [0] * len(scaffolds)
+
+    lines = []
+    for gene_number, scaffold in enumerate(gene_scaffolds, 1):
+        start = scaffold_ends[scaffold] + rng.randint(500, 5000)
+        gene_lines = _gene_lines(rng, args, scaffolds[scaffold][0], gene_number, start)
+        scaffold_ends[scaffold] = gene_lines[0][4]
+        lines.extend(gene_lines)
+    if args.shuffle:
+        rng.shuffle(lines)
+    else:
+        scaffold_ranks = {insdc_name: rank for rank, (insdc_name, community_name) in enumerate(scaffolds)}
+        lines.sort(key = lambda line: (scaffold_ranks[line[0]], line[3]))
+
+    gff_path = output_prefix + ".gff3"
+    with open(gff_path, "w") as gff_file:
+        gff_file.write("##gff-version 3\n")
+        for (insdc_name, community_name), scaffold_end in zip(scaffolds, scaffold_ends):
+            gff_file.write("##sequence-region %s 1 %d\n" % (insdc_name, scaffold_end + 1000))
+        gff_file.writelines("\t".join(map(str, line)) + "\n" for line in lines)
+
+    # Scaffold sequences are cut from one random block: only their names
+    # and lengths matter to the .gff tools.
+    fasta_path = output_prefix + ".fa"
+    sequence_block = "".join(rng.choices("ACGT", k = 60 * 1000))
+    with open(fasta_path, "w") as fasta_file:
+        for (insdc_name, community_name), scaffold_end in zip(scaffolds, scaffold_ends):
+            fasta_file.write(">" + insdc_name + "\n")
+            remaining = scaffold_end + 1000
+            while remaining > 0:
+                chunk = sequence_block[:min(remaining, len(sequence_block))]
+                fasta_file.write("\n".join(chunk[position:position + 60] for position in range(0, len(chunk), 60)) + "\n")
+                remaining -= len(chunk)
+
+    synonyms_path = output_prefix + "_synonyms.tsv"
+    with open(synonyms_path, "w") as synonyms_file:
+        for insdc_name, community_name in scaffolds:
+            synonyms_file.write("toplevel\t%s\t%s\tINSDC\n" % (community_name, insdc_name))
+
+    print_info("Wrote %d genes on %d scaffolds (%d .gff lines) to %s, %s and %s" %
+               (args.genes, args.scaffolds, len(lines), gff_path, fasta_path, synonyms_path))
+    return gff_path, fasta_path, synonyms_path
+
+
+def main():
+    args = get_args()
+    if args.genes < 1 or args.scaffolds < 1 or args.isoforms < 1:
+        exit_with_error("--genes, --scaffolds and --isoforms must be at least 1")
+    output_dir = os.path.dirname(args.output_prefix)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok = True)
+    write_synthetic_gff(args.output_prefix, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,55 +6,97 @@
 import json
 import datetime
 import argparse
-import operator
+import heapq
 import re
 import sys
-import subprocess
+import os
+import mmap
+import bisect
+import struct
+import gzip
+import zlib
+import tempfile
+import shutil
+import multiprocessing
+import collections
+import hashlib
+import sqlite3
 
-def chromosome_from_refseq(v, chr_map):
+# refseq_map is the inverse of a chrom2ncbi entry (see refseq2chrom)
+def chromosome_from_refseq(v, refseq_map):
     parts = v["sequenceOfReferenceAccessionNumber"].split(':',1)
-    for chrom, refseq in chr_map.items():
-        if refseq == parts[1]:
-            return chrom
+    return refseq_map.get(parts[1])
 
-    return
 
-
-def construct_hgvsg_id(v, refseq_chr, refSeq, varSeq):
-    stem = refseq_chr + ':g.'
-    if v["type"] == 'SO:0000159':
-        # deletion
-        hgvsg = stem + str(v["start"]) + '_' + str(v["end"]) + 'del'
-    elif v["type"] == 'SO:0000667':
-        # insertion
-        hgvsg = stem + str(v["start"]) + '_' + str(v["end"]) + 'ins'
-        if varSeq[1:] != '.':
-            hgvsg = hgvsg + varSeq[1:]
-    elif v["type"] == 'SO:1000032' or v["type"] == 'SO:0002007':
-        # deletion-insertion or multiple nucleotide substitution
-        hgvsg = stem + str(v["start"]) + '_' + str(v["end"]) + 'delins'
-        if varSeq[1:] != '.':
-            hgvsg = hgvsg + varSeq[1:]
-    elif v["type"] == 'SO:1000008':
-        # point mutation
-        hgvsg = stem + str(v["start"]) + refSeq + '>' + varSeq
+def variant_chromosome(v, mod):
+    if 'chromosome' not in v:
+        return chromosome_from_refseq(v, refseq2chrom[mod])
     else:
-        print("Unknown variation type " + v["type"] + " for " + v["alleleId"], file=sys.stderr)
-    
+        return str(v["chromosome"])
+
+
+def hgvsg_deletion(stem, v, refSeq, varSeq):
+    return stem + str(v["start"]) + '_' + str(v["end"]) + 'del'
+
+
+def hgvsg_insertion(stem, v, refSeq, varSeq):
+    hgvsg = stem + str(v["start"]) + '_' + str(v["end"]) + 'ins'
+    if varSeq[1:] != '.':
+        hgvsg = hgvsg + varSeq[1:]
     return hgvsg
 
 
-def genotype_string(variation, allStrains):
-    variationStrains = set(variation["strains"])
-    genotypes = []
+def hgvsg_delins(stem, v, refSeq, varSeq):
+    hgvsg = stem + str(v["start"]) + '_' + str(v["end"]) + 'delins'
+    if varSeq[1:] != '.':
+        hgvsg = hgvsg + varSeq[1:]
+    return hgvsg
 
-    for s in allStrains:
-        if s in variationStrains:
-            genotypes.append('1/1')
-        else:
-            genotypes.append('./.')
 
-    return "\t".join(genotypes)
+def hgvsg_point_mutation(stem, v, refSeq, varSeq):
+    return stem + str(v["start"]) + refSeq + '>' + varSeq
+
+
+# has_ref: reference allele is taken from the reference sequence
+# has_alt: alternative allele is taken from genomicVariantSequence
+# padded: VCF alleles need a padding base
+VariantType = collections.namedtuple('VariantType', ['name', 'has_ref', 'has_alt', 'padded', 'hgvsg'])
+
+variant_types = {
+    'SO:0000159': VariantType('deletion', True, False, True, hgvsg_deletion),
+    'SO:0000667': VariantType('insertion', False, True, True, hgvsg_insertion),
+    'SO:0002007': VariantType('multiple nucleotide substitution', True, True, True, hgvsg_delins),
+    'SO:1000008': VariantType('point mutation', True, True, False, hgvsg_point_mutation),
+    'SO:1000032': VariantType('deletion-insertion', True, True, True, hgvsg_delins),
+}
+
+
+def construct_hgvsg_id(v, refseq_chr, refSeq, varSeq):
+    if v["type"] not in variant_types:
+        print("Unknown variation type " + v["type"] + " for " + v["alleleId"], file=sys.stderr)
+        return
+    return variant_types[v["type"]].hgvsg(refseq_chr + ':g.', v, refSeq, varSeq)
+
+
+# Renders the GT columns of a variant for a fixed strain order. Strains are
+# mapped to column indices once; every column then occupies a fixed 4-character
+# slot ('./.' plus tab) of a precomputed all-missing row, so each variant's
+# columns are built by splicing '1/1' into that row at its carrier strains only.
+class StrainGenotypes:
+    def __init__(self, strains):
+        self.columns = {strain: i for i, strain in enumerate(strains)}
+        self.missing_row = "\t".join(['./.'] * len(strains))
+
+    def genotype_string(self, variation):
+        carriers = sorted({self.columns[s] for s in variation["strains"]})
+        parts = []
+        prev = 0
+        for column in carriers:
+            parts.append(self.missing_row[prev:column * 4])
+            parts.append('1/1')
+            prev = column * 4 + 3
+        parts.append(self.missing_row[prev:])
+        return ''.join(parts)
 
 
 def get_header_info(gff):
@@ -72,24 +114,175 @@ def get_header_info(gff):
             else:
                 return assembly, chr_lengths
             line = f.readline()
-    return assembly, chr_length
-
-#def get_chromosome_sequences(fasta):
-#    chr_seqs = {}
-#    with open(fasta, 'r') as f:
-#        line = f.readline()
-#        while line:
-#            if line.startswith('>'):
-#                chr_name = line[1:].split("\n")
-#            else:
-#                chr_seqs[chr_name] = chr_seqs[chr_name] + line.split("\n")
-#    return chr_seqs
+    return assembly, chr_lengths
+
+class IndexedFasta:
+    # In-process equivalent of `samtools faidx` region lookups. Reads the .fai
+    # once (building it, as samtools would, if it is missing) and serves slices
+    # from a memory-mapped FASTA, or from a BGZF-compressed FASTA via its .gzi.
+    def __init__(self, fasta):
+        self.path = fasta
+        self.fh = open(fasta, 'rb')
+        self.size = os.fstat(self.fh.fileno()).st_size
+        self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ) if self.size > 0 else b''
+        self.bgzf = is_bgzf(self.data)
+        if not self.bgzf and self.data[:2] == b'\x1f\x8b':
+            sys.exit("Cannot read " + fasta + ": files compressed with gzip must be recompressed with bgzip")
+        if self.bgzf:
+            self.gzi = read_gzi(fasta + '.gzi') if os.path.exists(fasta + '.gzi') else build_gzi(self.data)
+            self.block_cache = {}
+        if os.path.exists(fasta + '.fai'):
+            self.index = read_fai(fasta + '.fai')
+        else:
+            self.index = build_fai(fasta, self.bgzf)
+            write_fai(fasta + '.fai', self.index)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fh.close()
+
+    # Returns bases start-end (1-based, inclusive) of chrom, clamped to the
+    # sequence length, or an empty string for unknown or empty regions
+    def fetch(self, chrom, start, end):
+        if chrom not in self.index:
+            return ''
+        length, offset, line_bases, line_width = self.index[chrom]
+        start = max(int(start), 1) - 1
+        end = min(int(end), length)
+        if start >= end:
+            return ''
+        first = offset + (start // line_bases) * line_width + start % line_bases
+        last = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases
+        if self.bgzf:
+            raw = self._read_bgzf(first, last + 1)
+        else:
+            raw = self.data[first:last + 1]
+        return raw.translate(None, b'\r\n').decode('ascii')
+
+    def _read_bgzf(self, start, end):
+        # Find the block containing the first uncompressed offset, then inflate
+        # consecutive blocks until the range is covered
+        i = bisect.bisect_right(self.gzi[1], start) - 1
+        chunks = []
+        ustart = self.gzi[1][i]
+        coffset = self.gzi[0][i]
+        while ustart < end:
+            block, block_size = self._inflate_block(coffset)
+            if block_size == 0:
+                break
+            chunks.append(block[max(start - ustart, 0):end - ustart])
+            ustart += len(block)
+            coffset += block_size
+        return b''.join(chunks)
+
+    def _inflate_block(self, coffset):
+        if coffset in self.block_cache:
+            return self.block_cache[coffset]
+        block_size = bgzf_block_size(self.data, coffset)
+        if block_size is None:
+            return b'', 0
+        xlen = struct.unpack_from('<H', self.data, coffset + 10)[0]
+        block = zlib.decompress(self.data[coffset + 12 + xlen:coffset + block_size - 8], -15)
+        if len(self.block_cache) >= 64:
+            self.block_cache.clear()
+        self.block_cache[coffset] = (block, block_size)
+        return block, block_size
+
+
+def is_bgzf(data):
+    return len(data) >= 18 and data[:4] == b'\x1f\x8b\x08\x04' and bgzf_block_size(data, 0) is not None
+
+
+# Returns the total compressed size of the BGZF block at coffset, taken from
+# the BSIZE field of its 'BC' extra subfield
+def bgzf_block_size(data, coffset):
+    if coffset + 18 > len(data) or data[coffset:coffset + 2] != b'\x1f\x8b':
+        return None
+    xlen = struct.unpack_from('<H', data, coffset + 10)[0]
+    pos = coffset + 12
+    while pos < coffset + 12 + xlen:
+        si1, si2, slen = struct.unpack_from('<BBH', data, pos)
+        if si1 == 66 and si2 == 67:
+            return struct.unpack_from('<H', data, pos + 4)[0] + 1
+        pos += 4 + slen
+    return None
+
+
+# .gzi files list (compressed offset, uncompressed offset) pairs for every
+# block after the first; returned as two parallel lists including (0, 0)
+def read_gzi(gzi):
+    with open(gzi, 'rb') as f:
+        count = struct.unpack('<Q', f.read(8))[0]
+        pairs = struct.unpack('<' + str(count * 2) + 'Q', f.read(count * 16))
+    return [0] + list(pairs[0::2]), [0] + list(pairs[1::2])
+
+
+def build_gzi(data):
+    coffsets = []
+    uoffsets = []
+    coffset = 0
+    uoffset = 0
+    while coffset < len(data):
+        block_size = bgzf_block_size(data, coffset)
+        if block_size is None:
+            break
+        coffsets.append(coffset)
+        uoffsets.append(uoffset)
+        uoffset += struct.unpack_from('<I', data, coffset + block_size - 4)[0]
+        coffset += block_size
+    return coffsets, uoffsets
+
+
+def read_fai(fai):
+    index = {}
+    with open(fai, 'r') as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            index[columns[0]] = tuple(int(c) for c in columns[1:5])
+    return index
+
+
+# Single pass over the (uncompressed) FASTA recording the same
+# length/offset/line bases/line width columns as `samtools faidx`
+def build_fai(fasta, bgzf):
+    index = {}
+    f = gzip.open(fasta, 'rb') if bgzf else open(fasta, 'rb')
+    name = None
+    offset = 0
+    with f:
+        for line in f:
+            line_length = len(line)
+            if line.startswith(b'>'):
+                name = line[1:].split()[0].decode('ascii')
+                index[name] = [0, offset + line_length, 0, 0, False]
+            elif name is not None:
+                entry = index[name]
+                bases = len(line.rstrip(b'\r\n'))
+                if bases > 0 and (entry[4] or (entry[2] > 0 and bases > entry[2])):
+                    # Only the last line of a sequence may be shorter
+                    sys.exit("Different line length in sequence " + name + " in " + fasta)
+                if entry[2] == 0:
+                    entry[2] = bases
+                    entry[3] = line_length
+                elif bases < entry[2]:
+                    entry[4] = True
+                entry[0] += bases
+            offset += line_length
+    return {name: tuple(entry[:4]) for name, entry in index.items()}
+
+
+def write_fai(fai, index):
+    try:
+        with open(fai, 'w') as f:
+            for name, entry in index.items():
+                f.write("\t".join([name] + [str(e) for e in entry]) + "\n")
+    except OSError:
+        print("Could not write FASTA index " + fai + ", continuing with in-memory index", file=sys.stderr)
+
 
 def get_refseq_from_fasta(v, chrom, fasta):
-    faidx_call = subprocess.run(["samtools", "faidx", fasta, chrom + ':' + str(v["start"]) + '-' + str(v["end"])], stdout=subprocess.PIPE, text=True)
-    faidx_lines = faidx_call.stdout.split("\n");
-    faidx_lines.pop(0)
-    return ''.join(faidx_lines).upper()
+    return fasta.fetch(chrom, v["start"], v["end"]).upper()
 
 def get_padbase_from_fasta(v, chrom, fasta):
     if v["type"] == 'SO:0000667':
@@ -99,20 +292,7 @@ def get_padbase_from_fasta(v, chrom, fasta):
             pbpos = int(v["end"]) + 1
         else:
             pbpos = int(v["start"]) - 1
-    faidx_call = subprocess.run(["samtools", "faidx", fasta, chrom + ':' + str(pbpos) + '-' + str(pbpos)], stdout=subprocess.PIPE, text=True)
-    faidx_lines = faidx_call.stdout.split("\n");
-    faidx_lines.pop(0)
-    return faidx_lines[0].upper()
-
-#def get_padbase(v, chrom, chr_seqs):
-#    if v["type"] == 'SO:0000667':
-#        pbpos = int(v["start"])
-#    else:
-#        if v["start"] == 1:
-#            pbpos = int(v["end"]) + 1
-#        else:
-#            pbpos = int(v["start"]) - 1
-#    return chr_seqs[chrom][pbpos-1,pbpos]
+    return fasta.fetch(chrom, pbpos, pbpos).upper()
 
 def get_strains(variations):
     strains = set()
@@ -122,6 +302,95 @@ def get_strains(variations):
     return tuple(sorted(strains))
 
 
+# Incrementally decodes the elements of the top-level `key` array of a JSON
+# object, so that only one variant at a time needs to be held in memory.
+# Other top-level values (e.g. metaData) are decoded and discarded.
+def stream_json_array(json_file, key="data", chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    with open(json_file, 'r') as f:
+        reader = JSONChunkReader(f, decoder, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.decode()
+            reader.expect(':')
+            if name != key:
+                reader.decode()
+            elif reader.peek() == 'n':
+                reader.decode()
+            else:
+                reader.expect('[')
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield reader.decode()
+                        if reader.peek() == ',':
+                            reader.expect(',')
+                        else:
+                            reader.expect(']')
+                            break
+            if reader.peek() == ',':
+                reader.expect(',')
+            else:
+                reader.expect('}')
+                return
+
+
+class JSONChunkReader:
+    def __init__(self, fh, decoder, chunk_size):
+        self.fh = fh
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return
+
+    def peek(self):
+        self._skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError("Unexpected end of JSON input in " + self.fh.name)
+        return self.buffer[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '" + char + "' but found '" + self.buffer[self.pos] + "' in " + self.fh.name)
+        self.pos += 1
+
+    # Decodes the next complete JSON value, reading more input if the buffer
+    # ends part way through it. A value is only accepted once it is followed
+    # by a delimiter (or EOF), as e.g. a number could otherwise be truncated.
+    def decode(self):
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in ' \t\n\r,:]}'):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
 chromosomes = ('I', 'II', 'III', 'IV', 'V', 'X', 'MtDNA')
 
 chrom2ncbi = {
@@ -308,6 +577,9 @@ chrom2ncbi = {
     },
 }
 
+# Inverse of chrom2ncbi, for resolving chromosomes from RefSeq accessions
+refseq2chrom = {mod: {refseq: chrom for chrom, refseq in chr_map.items()} for mod, chr_map in chrom2ncbi.items()}
+
 expand_iupac = {
     'R': 'A,G',
     'Y': 'C,T',
@@ -322,88 +594,379 @@ expand_iupac = {
     'N': 'A,C,G,T'
 }
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-j", "--json", help="JSON input file")
-parser.add_argument("-g", "--gff", help="Corresponding GFF file")
-parser.add_argument("-o", "--out", help="Output VCF file")
-parser.add_argument("-m", "--mod", help="Acronym for MOD")
-parser.add_argument("-f", "--fasta", help="FASTA file")
-parser.add_argument("-s", "--strains", action='store_true', help="Input includes strain data")
-parser.add_argument("-w", "--wbhtp", action='store_true', help="WB high throughput data")
-
-args = parser.parse_args()
-assembly, chr_lengths = get_header_info(args.gff)
-#if not args.wbhtp:
-#    print("Retrieving chromosome sequences for " + args.mod + "\n")
-#    chr_seqs = get_chromosome_sequences(args.fasta)
-
-vcf_file = open(args.out, 'w')
-
-vcf_file.write("##fileformat=VCFv4.2\n" +
-               datetime.datetime.today().strftime("##fileDate=%Y%m%d") + "\n" +
-               "##reference=" + assembly + "\n" +
-               "##source=AllianceJSON\n")
-
-for chr in chrom2ncbi[args.mod]:
-    if chr in chr_lengths:
-        vcf_file.write("##contig=<ID=" + chr + ",accession=\"" + chrom2ncbi[args.mod][chr] + "\",length=" + chr_lengths[chr] + ">\n")
-    else:
-        vcf_file.write("##contig=<ID=" + chr + ",accession=\"" + chrom2ncbi[args.mod][chr] + "\">\n")
+# External merge sort of VCF lines by (contig order, pos). Rendered lines are
+# appended to a temporary line store as they arrive and only compact
+# (chrom index, pos, offset) records are kept in memory; these are spilled to
+# disk as sorted runs whenever the buffer fills and k-way merged at the end.
+# Ties keep their input order as the store offset is monotonic.
+class ExternalSorter:
+    record = struct.Struct('<IqQ')
 
-if args.strains:
-    vcf_file.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n")
+    max_merge = 256
 
-headers = ['#CHROM', 'POS', 'ID', 'REF',
-           'ALT', 'QUAL', 'FILTER', 'INFO']
+    def __init__(self, chromosomes, buffer_size=1000000, tmpdir=None):
+        self.chrom_index = {chrom: i for i, chrom in enumerate(chromosomes)}
+        self.buffer_size = buffer_size
+        self.tmpdir = tempfile.TemporaryDirectory(prefix='agr_vcf_sort_', dir=tmpdir)
+        self.lines = open(os.path.join(self.tmpdir.name, 'lines'), 'wb')
+        self.offset = 0
+        self.buffer = []
+        self.runs = []
 
-nt_regex = re.compile('^[ACGT]$')
+    def add(self, chrom, pos, line):
+        data = (line + "\n").encode()
+        self.buffer.append((self.chrom_index[chrom], pos, self.offset))
+        self.lines.write(data)
+        self.offset += len(data)
+        if len(self.buffer) >= self.buffer_size:
+            self._spill()
 
-with open(args.json, 'r') as read_file:
-    parsed = json.load(read_file)
+    def _spill(self):
+        self.buffer.sort()
+        self._write_run(self.buffer)
+        self.buffer = []
 
-# get all strains for column headers
-if args.strains:
-    headers.append('FORMAT')
-    strains = get_strains(parsed["data"])
-    for s in strains:
-        headers.append('WB:' + s)  # need curie form of strain
-    
-vcf_file.write("\t".join(headers) + "\n")
+    def _write_run(self, records):
+        run = os.path.join(self.tmpdir.name, 'run' + str(len(self.runs)))
+        with open(run, 'wb') as f:
+            chunk = []
+            for r in records:
+                chunk.append(self.record.pack(*r))
+                if len(chunk) >= 65536:
+                    f.write(b''.join(chunk))
+                    chunk = []
+            f.write(b''.join(chunk))
+        self.runs.append(run)
 
-vcf_lines = []
-added_entries = set()
-var_count = 0
-for v in (parsed["data"]):
-    vcf_data = {}
+    def _read_run(self, run, chunk_records=65536):
+        with open(run, 'rb') as f:
+            while True:
+                chunk = f.read(self.record.size * chunk_records)
+                if not chunk:
+                    return
+                yield from self.record.iter_unpack(chunk)
 
-    if 'chromosome' not in v:
-        chr = chromosome_from_refseq(v, chrom2ncbi[args.mod])
-    else:
-        chr = str(v["chromosome"])
-        
-    # SO:0000159 - deletion
-    # SO:0000667 - insertion
-    # SO:0002007 - multiple nucleotide substitution
-    # SO:1000008 - point mutation
-    # SO:1000032 - deletion-insertion
+    # Yields the stored lines in sorted order
+    def sorted_lines(self):
+        self.lines.close()
+        if self.runs:
+            if self.buffer:
+                self._spill()
+            # Keep the number of simultaneously open runs bounded
+            merged = 0
+            while len(self.runs) - merged > self.max_merge:
+                group = self.runs[merged:merged + self.max_merge]
+                self._write_run(heapq.merge(*[self._read_run(run) for run in group]))
+                for run in group:
+                    os.remove(run)
+                merged += self.max_merge
+            records = heapq.merge(*[self._read_run(run) for run in self.runs[merged:]])
+        else:
+            self.buffer.sort()
+            records = iter(self.buffer)
+        if self.offset == 0:
+            return
+        with open(self.lines.name, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for record in records:
+                offset = record[2]
+                yield data[offset:data.find(b'\n', offset) + 1].decode()
+            data.close()
+
+    def close(self):
+        self.lines.close()
+        self.tmpdir.cleanup()
+
+
+# Writes BGZF blocks (RFC 1952 gzip members with a 'BC' extra subfield
+# holding the block size), as produced by bgzip
+class BgzfWriter:
+    block_size = 0xff00
+    eof_block = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self, path):
+        self.fh = open(path, 'wb')
+        self.coffset = 0
+        self.buffer = bytearray()
+
+    # Virtual offset of the next byte to be written
+    def tell(self):
+        return (self.coffset << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._flush_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+    def _flush_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+        self.fh.write(header + compressed + struct.pack('<II', zlib.crc32(data), len(data)))
+        self.coffset += len(compressed) + 26
+
+    def close(self):
+        if self.buffer:
+            self._flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(self.eof_block)
+        self.fh.close()
+
+
+# Tabix (.tbi) index built while records are streamed in sorted order, using
+# the same binning scheme (5 levels, 16kb linear windows) as htslib
+class TabixIndex:
+    min_shift = 14
+    meta_bin = 37450
+
+    def __init__(self):
+        self.refs = []
+        self.current = None
+
+    def add(self, chrom, beg, end, voffset_start, voffset_end):
+        if self.current is None or self.current['name'] != chrom:
+            self.current = {'name': chrom, 'bins': {}, 'linear': [], 'off_beg': voffset_start,
+                            'off_end': voffset_end, 'n_mapped': 0}
+            self.refs.append(self.current)
+        ref = self.current
+        chunks = ref['bins'].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == voffset_start:
+            chunks[-1][1] = voffset_end
+        else:
+            chunks.append([voffset_start, voffset_end])
+        linear = ref['linear']
+        last_window = (end - 1) >> self.min_shift
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> self.min_shift, last_window + 1):
+            if linear[window] is None:
+                linear[window] = voffset_start
+        ref['off_end'] = voffset_end
+        ref['n_mapped'] += 1
+
+    def write(self, path):
+        names = b''.join(ref['name'].encode() + b'\0' for ref in self.refs)
+        # n_ref, format (2 = VCF), col_seq, col_beg, col_end, meta char, skip
+        data = [b'TBI\1', struct.pack('<7i', len(self.refs), 2, 1, 2, 0, ord('#'), 0),
+                struct.pack('<i', len(names)), names]
+        for ref in self.refs:
+            data.append(struct.pack('<i', len(ref['bins']) + 1))
+            for bin, chunks in ref['bins'].items():
+                data.append(struct.pack('<Ii', bin, len(chunks)))
+                data.extend(struct.pack('<QQ', *chunk) for chunk in chunks)
+            data.append(struct.pack('<IiQQQQ', self.meta_bin, 2, ref['off_beg'], ref['off_end'], ref['n_mapped'], 0))
+            linear = ref['linear']
+            previous = 0
+            for window, voffset in enumerate(linear):
+                if voffset is None:
+                    linear[window] = previous
+                else:
+                    previous = voffset
+            data.append(struct.pack('<i', len(linear)))
+            data.append(struct.pack('<' + str(len(linear)) + 'Q', *linear))
+        data.append(struct.pack('<Q', 0))
+        index = BgzfWriter(path)
+        index.write(b''.join(data))
+        index.close()
+
+
+# Bin of the smallest binning-index level containing [beg, end)
+def reg2bin(beg, end):
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+# Text-file-like writer producing a BGZF-compressed VCF and its tabix index.
+# Accepts arbitrary chunks of text; complete record lines are indexed as they
+# are written, so records must arrive in sorted order.
+class IndexedVcfWriter:
+    def __init__(self, path):
+        self.path = path
+        self.bgzf = BgzfWriter(path)
+        self.index = TabixIndex()
+        self.partial = ''
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self._write_line(line)
+
+    def _write_line(self, line):
+        voffset_start = self.bgzf.tell()
+        self.bgzf.write((line + "\n").encode())
+        if not line.startswith('#'):
+            chrom, pos, id, ref = line.split("\t", 4)[:4]
+            beg = int(pos) - 1
+            self.index.add(chrom, beg, beg + max(len(ref), 1), voffset_start, self.bgzf.tell())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.partial:
+            self._write_line(self.partial)
+            self.partial = ''
+        self.bgzf.close()
+        self.index.write(self.path + '.tbi')
 
+
+# Sidecar cache of rendered VCF lines keyed on alleleId and a hash of the
+# allele's JSON content, so that a rerun only resolves reference and pad bases
+# for new or changed alleles. Each run reads the previous cache and writes a
+# fresh one holding the records of the current input only.
+class RecordCache:
+    version = 1
+
+    def __init__(self, previous_path, context, new_path):
+        self.previous = None
+        if previous_path is not None and os.path.exists(previous_path):
+            db = sqlite3.connect('file:' + previous_path + '?mode=ro', uri=True)
+            try:
+                stored = db.execute("SELECT value FROM meta WHERE key = 'context'").fetchone()
+            except sqlite3.DatabaseError:
+                stored = None
+            if stored is not None and stored[0] == context:
+                self.previous = db
+                self.previous_path = previous_path
+            else:
+                print("Not reusing " + previous_path + " as it was built from a different reference, MOD, strain set or options", file=sys.stderr)
+                db.close()
+        if self.previous is None:
+            self.previous_path = None
+
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        self.new = sqlite3.connect(new_path)
+        self.new.execute("PRAGMA synchronous = OFF")
+        self.new.execute("PRAGMA journal_mode = OFF")
+        self.new.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.new.execute("CREATE TABLE records (allele_id TEXT PRIMARY KEY, hash BLOB, line TEXT)")
+        self.new.execute("INSERT INTO meta VALUES ('context', ?)", (context,))
+        self.pending = []
+        self.reused = 0
+
+    def get(self, allele_id, digest):
+        if self.previous is None:
+            return None
+        row = self.previous.execute("SELECT line FROM records WHERE allele_id = ? AND hash = ?", (allele_id, digest)).fetchone()
+        if row is None:
+            return None
+        self.reused += 1
+        return row[0]
+
+    def put(self, allele_id, digest, line):
+        self.pending.append((allele_id, digest, line))
+        if len(self.pending) >= 10000:
+            self._flush()
+
+    def _flush(self):
+        self.new.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", self.pending)
+        self.pending = []
+
+    # Adds the records of another (e.g. per-chromosome worker) cache
+    def merge(self, other_path):
+        self._flush()
+        self.new.execute("ATTACH DATABASE ? AS other", (other_path,))
+        self.new.execute("INSERT OR REPLACE INTO records SELECT * FROM other.records")
+        self.new.commit()
+        self.new.execute("DETACH DATABASE other")
+
+    def close(self):
+        self._flush()
+        self.new.commit()
+        self.new.close()
+        if self.previous is not None:
+            self.previous.close()
+
+
+def allele_hash(v):
+    return hashlib.blake2b(json.dumps(v, sort_keys=True, separators=(',', ':')).encode(), digest_size=16).digest()
+
+
+# Hash of everything besides an allele's own content that its rendered record
+# depends on; a cache built with a different context is not reused. The
+# reference is identified by its size, modification time and .fai (and .gzi)
+# index rather than by its bases, so that checking the cache does not read
+# the whole genome.
+def cache_context(mod, wbhtp, strains, fasta):
+    context = hashlib.blake2b(digest_size=16)
+    context.update(json.dumps([RecordCache.version, mod, wbhtp, strains]).encode())
+    if fasta is not None:
+        stat = os.fstat(fasta.fh.fileno())
+        context.update(json.dumps([stat.st_size, stat.st_mtime_ns, sorted(fasta.index.items()),
+                                   fasta.gzi if fasta.bgzf else None]).encode())
+    return context.hexdigest()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--json", help="JSON input file")
+    parser.add_argument("-g", "--gff", help="Corresponding GFF file")
+    parser.add_argument("-o", "--out", help="Output VCF file")
+    parser.add_argument("-m", "--mod", help="Acronym for MOD")
+    parser.add_argument("-f", "--fasta", help="FASTA file")
+    parser.add_argument("-s", "--strains", action='store_true', help="Input includes strain data")
+    parser.add_argument("-w", "--wbhtp", action='store_true', help="WB high throughput data")
+    parser.add_argument("--sort_buffer", type=int, default=1000000, help="Number of records to sort in memory before spilling to disk")
+    parser.add_argument("--tmpdir", help="Directory for temporary sort files (defaults to the system temporary directory)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes converting chromosomes in parallel")
+    parser.add_argument("-z", "--bgzip", action='store_true', help="Write BGZF-compressed VCF and build its tabix (.tbi) index")
+    parser.add_argument("-c", "--cache", help="Sidecar cache of rendered records, reused for unchanged alleles and updated on each run")
+    return parser.parse_args()
+
+
+def write_header(vcf_file, mod, assembly, chr_lengths, strains):
+    vcf_file.write("##fileformat=VCFv4.2\n" +
+                   datetime.datetime.today().strftime("##fileDate=%Y%m%d") + "\n" +
+                   "##reference=" + assembly + "\n" +
+                   "##source=AllianceJSON\n")
+
+    for chr in chrom2ncbi[mod]:
+        if chr in chr_lengths:
+            vcf_file.write("##contig=<ID=" + chr + ",accession=\"" + chrom2ncbi[mod][chr] + "\",length=" + chr_lengths[chr] + ">\n")
+        else:
+            vcf_file.write("##contig=<ID=" + chr + ",accession=\"" + chrom2ncbi[mod][chr] + "\">\n")
+
+    if strains is not None:
+        vcf_file.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n")
+
+    headers = ['#CHROM', 'POS', 'ID', 'REF',
+               'ALT', 'QUAL', 'FILTER', 'INFO']
+
+    if strains is not None:
+        headers.append('FORMAT')
+        for s in strains:
+            headers.append('WB:' + s)  # need curie form of strain
+
+    vcf_file.write("\t".join(headers) + "\n")
+
+
+nt_regex = re.compile('^[ACGT]$')
+
+# Returns the VCF position and padded reference and alternative alleles of a
+# variant, or None if the specified reference allele doesn't match the reference
+def build_alleles(v, variant_type, chr, fasta, wbhtp=False):
     pos = int(v["start"])
-        
+
     # Get reference allele
-    if v["type"] == 'SO:0000667':
+    if not variant_type.has_ref:
         refSeq = ''
-    elif args.wbhtp:
+    elif wbhtp:
         refSeq = v["genomicReferenceSequence"]
     else:
-        refSeq = get_refseq_from_fasta(v, chr, args.fasta)
-#        refSeq = chr_seqs[chr][int(v["start"]) - 1:int(v["end"]) - 1]
+        refSeq = get_refseq_from_fasta(v, chr, fasta)
         if 'genomicReferenceSequence' in v and v["genomicReferenceSequence"].upper() != refSeq:
             print("Specified genomic reference allele (" + v["genomicReferenceSequence"] + ") doesn't match reference sequence ("
                   + refSeq + ") at specified coordinates for " + v["alleleId"], file=sys.stderr)
-            continue
+            return
 
     # Get alternative allele
-    if v["type"] == 'SO:0000159':
+    if not variant_type.has_alt:
         varSeq = ''
     elif 'genomicVariantSequence' not in v or v["genomicVariantSequence"] == '' or v["genomicVariantSequence"] == "N/A":
         print("Unknown alternative allele for " + v["alleleId"], file=sys.stderr)
@@ -414,17 +977,17 @@ for v in (parsed["data"]):
     # Remove any whitespace from sequences
     varSeq = ''.join(varSeq.split())
     refSeq = ''.join(refSeq.split())
-        
+
     # Add padded base and adjust pos if required
-    if v["type"] == 'SO:0000159' or v["type"] == 'SO:0000667' or v["type"] == 'SO:1000032' or v["type"] == 'SO:0002007':
-        if v["type"] != 'SO:0000667' and pos != 1:
+    if variant_type.padded:
+        if variant_type.has_ref and pos != 1:
             pos = pos - 1
-            
+
         if 'paddedBase' in v:
             padBase = v["paddedBase"]
         else:
-            padBase = get_padbase_from_fasta(v, chr, args.fasta)
-                
+            padBase = get_padbase_from_fasta(v, chr, fasta)
+
         if pos == 1:
             refSeq = refSeq + padBase
             varSeq = varSeq + padBase
@@ -432,44 +995,246 @@ for v in (parsed["data"]):
             refSeq = padBase + refSeq
             varSeq = padBase + varSeq
 
-    vcf_data["chromosome"] = chr
-    vcf_data["pos"] = pos
+    return pos, refSeq, varSeq
+
+
+# Converts a stream of AGR variants into (chromosome, pos, VCF line) records,
+# skipping variants that fail validation. Duplicate records are dropped after
+# sorting, by unique_lines.
+def vcf_records(variants, mod, fasta, strains=None, wbhtp=False, cache=None):
+    var_count = 0
+    genotypes = None
+    if strains is not None:
+        genotypes = StrainGenotypes(strains)
+    for v in variants:
+        digest = None
+        record = None
+        if cache is not None:
+            digest = allele_hash(v)
+            line = cache.get(v["alleleId"], digest)
+            if line is not None:
+                chr, pos, hgvsg, refSeq, varSeq = line.split("\t", 5)[:5]
+                record = (chr, int(pos), refSeq, varSeq, line)
+        if record is None:
+            record = render_record(v, mod, fasta, genotypes, wbhtp)
+            if record is None:
+                continue
+        chr, pos, refSeq, varSeq, line = record
+        if cache is not None:
+            cache.put(v["alleleId"], digest, line)
+
+        yield chr, pos, line
+
+        var_count += 1
+        if var_count % 10000 == 0:
+            print(str(var_count) + " variations processed\n")
+
+
+# Drops the sorted VCF lines that repeat the CHROM, POS, REF and ALT of an
+# earlier line. Sorting brings duplicates to the same position and keeps ties
+# in input order, so only the current position's alleles are held in memory
+# and the first of the duplicates is kept, as before sorting.
+def unique_lines(lines):
+    position = None
+    alleles = set()
+    for line in lines:
+        chr, pos, hgvsg, refSeq, varSeq = line.split("\t", 5)[:5]
+        if (chr, pos) != position:
+            position = (chr, pos)
+            alleles.clear()
+        # There are cases where the same genetic change has multiple variaton IDs
+        if (refSeq, varSeq) in alleles:
+            continue
+        alleles.add((refSeq, varSeq))
+        yield line
+
+
+# Returns (chromosome, pos, REF, ALT, VCF line) for a variant, or None if it
+# has to be skipped
+def render_record(v, mod, fasta, genotypes, wbhtp=False):
+    variant_type = variant_types.get(v["type"])
+    if variant_type is None:
+        print("Unknown variation type " + v["type"] + " for " + v["alleleId"] + " - skipping", file=sys.stderr)
+        return
+
+    chr = variant_chromosome(v, mod)
+
+    alleles = build_alleles(v, variant_type, chr, fasta, wbhtp)
+    if alleles is None:
+        return
+    pos, refSeq, varSeq = alleles
 
     origVarSeq = varSeq
     if len(varSeq) == 1:
         if nt_regex.match(varSeq) is None:
             if varSeq in expand_iupac:
                 varSeq = expand_iupac[varSeq]
-                if args.strains:
+                if genotypes is not None:
                     # Don't know genotypes of strains where there are multiple alternative alleles, so skip
-                    continue
+                    return
             else:
                 print("Unrecognised alternative allele " + varSeq + " for " + v["alleleId"] + " - skipping", file=sys.stderr)
-                continue
-    
-    # There are cases where the same genetic change has multiple variaton IDs
-    entry = '|'.join((chr, str(pos), refSeq, varSeq))
-    if entry in added_entries:
-        continue
+                return
+
+    hgvsg = variant_type.hgvsg(chrom2ncbi[mod][chr] + ':g.', v, refSeq, origVarSeq)
+
+    if genotypes is not None:
+        gtString = genotypes.genotype_string(v)
+        line = "\t".join([chr, str(pos), hgvsg, refSeq, varSeq, '.', 'PASS', '.', 'GT', gtString])
     else:
-        added_entries.add(entry)
-                
-    hgvsg = construct_hgvsg_id(v, chrom2ncbi[args.mod][chr], refSeq, origVarSeq)
+        line = "\t".join([chr, str(pos), hgvsg, refSeq, varSeq, '.', '.' ,'.'])
+
+    return chr, pos, refSeq, varSeq, line
+
+
+# Splits the variants into one JSON lines file per chromosome. Strain names
+# are collected on the way so that no separate pass is needed for the header.
+def partition_variants(variants, mod, partition_dir, collect_strains=False):
+    partitions = {}
+    strains = set()
+    for v in variants:
+        chrom = variant_chromosome(v, mod)
+        if chrom not in partitions:
+            path = os.path.join(partition_dir, 'partition' + str(len(partitions)) + '.json')
+            partitions[chrom] = (path, open(path, 'w'))
+        partitions[chrom][1].write(json.dumps(v) + "\n")
+        if collect_strains:
+            strains.update(v["strains"])
+
+    for path, f in partitions.values():
+        f.close()
+
+    return {chrom: path for chrom, (path, f) in partitions.items()}, tuple(sorted(strains))
+
+
+def read_partition(partition):
+    with open(partition, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# Converts and sorts the variants of a single chromosome partition into a VCF
+# shard. Runs in a worker process, so opens its own reference handle.
+def convert_partition(task):
+    chrom, partition, shard, mod, fasta_file, strains, wbhtp, sort_buffer, tmpdir, cache_file, context = task
+    fasta = None
+    if fasta_file:
+        fasta = IndexedFasta(fasta_file)
+
+    cache = None
+    if context is not None:
+        cache = RecordCache(cache_file, context, shard + '.cache')
+
+    sorter = ExternalSorter(chrom2ncbi[mod], buffer_size=sort_buffer, tmpdir=tmpdir)
+    for chr, pos, line in vcf_records(read_partition(partition), mod, fasta, strains=strains, wbhtp=wbhtp, cache=cache):
+        sorter.add(chr, pos, line)
+
+    if cache is not None:
+        cache.close()
+
+    with open(shard, 'w') as f:
+        for line in unique_lines(sorter.sorted_lines()):
+            f.write(line)
 
-    if args.strains:
-        gtString = genotype_string(v, strains)
-        vcf_data["line"] = "\t".join([chr, str(pos), hgvsg, refSeq, varSeq, '.', 'PASS', '.', 'GT', gtString])
+    sorter.close()
+    if fasta is not None:
+        fasta.close()
+
+    return chrom, shard
+
+
+def write_records_parallel(vcf_file, args, assembly, chr_lengths, fasta):
+    with tempfile.TemporaryDirectory(prefix='agr_vcf_partitions_', dir=args.tmpdir) as partition_dir:
+        print("Partitioning variations by chromosome\n")
+        partitions, strains = partition_variants(stream_json_array(args.json), args.mod, partition_dir,
+                                                 collect_strains=args.strains)
+        strains = strains if args.strains else None
+        write_header(vcf_file, args.mod, assembly, chr_lengths, strains)
+
+        # Workers read the previous cache and write their records to per-shard
+        # caches, which are merged into the new cache afterwards
+        cache = None
+        context = None
+        if args.cache:
+            context = cache_context(args.mod, args.wbhtp, strains, fasta)
+            cache = RecordCache(args.cache, context, args.cache + '.new')
+
+        # Start the largest partitions first to keep the workers evenly loaded
+        tasks = []
+        for i, (chrom, partition) in enumerate(partitions.items()):
+            tasks.append((chrom, partition, os.path.join(partition_dir, 'shard' + str(i) + '.vcf'), args.mod,
+                          args.fasta, strains, args.wbhtp, args.sort_buffer, args.tmpdir,
+                          cache.previous_path if cache is not None else None, context))
+        tasks.sort(key=lambda t: os.path.getsize(t[1]), reverse=True)
+
+        print("Converting " + str(len(tasks)) + " chromosomes with " + str(args.workers) + " workers\n")
+        with multiprocessing.Pool(args.workers) as pool:
+            shards = dict(pool.imap_unordered(convert_partition, tasks))
+
+        if cache is not None:
+            for shard in shards.values():
+                cache.merge(shard + '.cache')
+            cache.close()
+
+        # Shards are already sorted, so concatenating in contig order gives the
+        # same record order as a serial run
+        vcf_file.flush()
+        for chrom in chrom2ncbi[args.mod]:
+            if chrom in shards:
+                with open(shards[chrom], 'r') as shard:
+                    shutil.copyfileobj(shard, vcf_file)
+
+
+def main():
+    args = get_args()
+    assembly, chr_lengths = get_header_info(args.gff)
+    fasta = None
+    if args.fasta:
+        # Also builds the .fai up front if missing, before any workers start
+        fasta = IndexedFasta(args.fasta)
+
+    if args.bgzip:
+        vcf_file = IndexedVcfWriter(args.out)
+    else:
+        vcf_file = open(args.out, 'w')
+
+    if args.workers > 1:
+        write_records_parallel(vcf_file, args, assembly, chr_lengths, fasta)
     else:
-        vcf_data["line"] = "\t".join([chr, str(pos), hgvsg, refSeq, varSeq, '.', '.' ,'.'])
+        # get all strains for column headers (requires a first pass over the variants)
+        strains = None
+        if args.strains:
+            strains = get_strains(stream_json_array(args.json))
+
+        write_header(vcf_file, args.mod, assembly, chr_lengths, strains)
+
+        cache = None
+        if args.cache:
+            cache = RecordCache(args.cache, cache_context(args.mod, args.wbhtp, strains, fasta), args.cache + '.new')
+
+        # Lines are written in contig (chrom2ncbi) order, matching the header
+        sorter = ExternalSorter(chrom2ncbi[args.mod], buffer_size=args.sort_buffer, tmpdir=args.tmpdir)
+        for chr, pos, line in vcf_records(stream_json_array(args.json), args.mod, fasta, strains=strains, wbhtp=args.wbhtp, cache=cache):
+            sorter.add(chr, pos, line)
+
+        if cache is not None:
+            print(str(cache.reused) + " records reused from " + args.cache + "\n")
+            cache.close()
+
+        print("Sorting VCF lines\n")
+        for line in unique_lines(sorter.sorted_lines()):
+            vcf_file.write(line)
+
+        sorter.close()
+
+    vcf_file.close()
+    if fasta is not None:
+        fasta.close()
 
-    vcf_lines.append(vcf_data)
-    
-    var_count += 1
-    if var_count % 10000 == 0:
-        print(str(var_count) + " variations processed\n")
+    # Only replace the previous cache once the VCF has been written
+    if args.cache:
+        os.replace(args.cache + '.new', args.cache)
 
-print("Sorting VCF lines\n")
-for v in sorted(vcf_lines, key=operator.itemgetter('chromosome', 'pos')):
-    vcf_file.write(v["line"] + "\n")
 
-vcf_file.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# Benchmarks for agr_variations_json2vcf.py on synthetic data, so that no MOD
+# submission or genome FASTA is needed.
+#
+# stages: micro-benchmark of the per-variant stages (chromosome resolution,
+#   ref/alt allele building and HGVS construction) for every handled SO type
+#   on each MOD's contigs. Reports ns/variant per MOD and stage as TSV. With
+#   --baseline (a TSV written by an earlier run) exits non-zero if any stage is
+#   slower than the baseline by more than --tolerance, so it can be used as a
+#   CI regression check.
+#
+# suite: end-to-end conversion of a synthetic allele JSON against a matching
+#   synthetic FASTA (with .fai) and GFF header, with and without --strains and
+#   --wbhtp. Each configuration runs in its own process and reports
+#   variants/sec, peak RSS and the time spent parsing JSON, in reference
+#   lookups, rendering records, in the dedup loop and sorting. Stage times are
+#   exclusive and only cover the main process, so are not collected for
+#   conversions passed --workers.
+
+import argparse
+import gc
+import gzip
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import agr_variations_json2vcf as converter
+
+
+def synthetic_variants(mod, count, seed=0):
+    rng = random.Random(seed)
+    chroms = list(converter.chrom2ncbi[mod])
+    so_terms = sorted(converter.variant_types)
+    variants = []
+    for i in range(count):
+        chrom = rng.choice(chroms)
+        so_term = so_terms[i % len(so_terms)]
+        start = rng.randint(2, 10000000)
+        length = 1 if so_term == 'SO:1000008' else rng.randint(1, 20)
+        v = {"alleleId": mod + ':VAR' + str(i), "type": so_term, "start": start,
+             "end": start + 1 if so_term == 'SO:0000667' else start + length - 1,
+             "genomicReferenceSequence": ''.join(rng.choice('ACGT') for _ in range(length)),
+             "genomicVariantSequence": ''.join(rng.choice('ACGT') for _ in range(rng.randint(1, 5))),
+             "paddedBase": rng.choice('ACGT')}
+        if i % 2:
+            v["chromosome"] = chrom
+        else:
+            v["sequenceOfReferenceAccessionNumber"] = 'RefSeq:' + converter.chrom2ncbi[mod][chrom]
+        variants.append(v)
+    return variants
+
+
+# Fastest of several timed passes, with GC disabled as in timeit
+def time_per_variant(func, inputs, repeats):
+    gc.collect()
+    gc.disable()
+    try:
+        best = min(time_pass(func, inputs) for _ in range(repeats))
+    finally:
+        gc.enable()
+    return best / len(inputs) * 1e9
+
+
+def time_pass(func, inputs):
+    start = time.perf_counter()
+    for args in inputs:
+        func(*args)
+    return time.perf_counter() - start
+
+
+def benchmark_mod(mod, count, repeats):
+    variants = synthetic_variants(mod, count)
+    types = [converter.variant_types[v["type"]] for v in variants]
+    chroms = [converter.variant_chromosome(v, mod) for v in variants]
+    alleles = [converter.build_alleles(v, vt, c, None, wbhtp=True) for v, vt, c in zip(variants, types, chroms)]
+
+    results = {}
+    results['chromosome'] = time_per_variant(converter.variant_chromosome,
+                                             [(v, mod) for v in variants], repeats)
+    results['alleles'] = time_per_variant(lambda v, vt, c: converter.build_alleles(v, vt, c, None, wbhtp=True),
+                                          list(zip(variants, types, chroms)), repeats)
+    results['hgvsg'] = time_per_variant(lambda v, vt, c, a: vt.hgvsg(converter.chrom2ncbi[mod][c] + ':g.', v, a[1], a[2]),
+                                        list(zip(variants, types, chroms, alleles)), repeats)
+    return results
+
+
+def read_baseline(baseline):
+    timings = {}
+    with open(baseline, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            mod, stage, ns = line.rstrip("\n").split("\t")
+            timings[(mod, stage)] = float(ns)
+    return timings
+
+
+def run_stages(args):
+    lines = ["#mod\tstage\tns_per_variant"]
+    results = {}
+    for mod in args.mods:
+        for stage, ns in benchmark_mod(mod, args.variants, args.repeats).items():
+            results[(mod, stage)] = ns
+            lines.append(mod + "\t" + stage + "\t" + '{:.1f}'.format(ns))
+
+    print("\n".join(lines))
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+    if args.baseline:
+        regressions = []
+        for key, ns in read_baseline(args.baseline).items():
+            if key in results and results[key] > ns * args.tolerance:
+                regressions.append(key[0] + " " + key[1] + ": " + '{:.1f}'.format(results[key]) + " ns/variant (baseline " + '{:.1f}'.format(ns) + ")")
+        if regressions:
+            print("Per-variant cost regressed beyond " + str(args.tolerance) + "x baseline:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+# Writes a random genome for the MOD's contigs as FASTA (60 bases per line)
+# plus its .fai, and a GFF holding only the header lines the converter reads.
+# Returns the contig sequences.
+def write_synthetic_genome(workdir, mod, chrom_length, rng):
+    sequences = {}
+    fasta = os.path.join(workdir, mod + '_FASTA.fa')
+    with open(fasta, 'w') as f:
+        for chrom in converter.chrom2ncbi[mod]:
+            sequence = ''.join(rng.choices('ACGT', k=chrom_length))
+            sequences[chrom] = sequence
+            f.write('>' + chrom + "\n")
+            for i in range(0, chrom_length, 60):
+                f.write(sequence[i:i + 60] + "\n")
+    converter.IndexedFasta(fasta).close()
+
+    with open(os.path.join(workdir, mod + '_GFF.gff'), 'w') as f:
+        f.write("##gff-version 3\n#!assembly synthetic\n")
+        for chrom in converter.chrom2ncbi[mod]:
+            f.write("##sequence-region " + chrom + " 1 " + str(chrom_length) + "\n")
+
+    return sequences
+
+
+# Writes AGR allele JSON covering every SO type handled by the converter, with
+# reference alleles matching the synthetic genome, a proportion of duplicated
+# changes (exercising dedup) and a random subset of strains per variant
+def write_synthetic_variants(workdir, mod, sequences, count, n_strains, duplicate_rate, rng):
+    so_terms = sorted(converter.variant_types)
+    strains = ['STRAIN' + str(i) for i in range(n_strains)]
+    chroms = list(sequences)
+    previous = None
+    with open(os.path.join(workdir, mod + '_VARIATION.json'), 'w') as f:
+        f.write('{"metaData": {"dataProvider": "' + mod + '"}, "data": [\n')
+        for i in range(count):
+            if previous is not None and rng.random() < duplicate_rate:
+                v = dict(previous)
+            else:
+                so_term = so_terms[i % len(so_terms)]
+                chrom = rng.choice(chroms)
+                length = 1 if so_term == 'SO:1000008' else rng.randint(1, 20)
+                start = rng.randint(2, len(sequences[chrom]) - length - 1)
+                v = {"type": so_term, "start": start, "end": start + length - 1}
+                if so_term == 'SO:0000667':
+                    v["end"] = start + 1
+                else:
+                    v["genomicReferenceSequence"] = sequences[chrom][start - 1:start + length - 1]
+                if so_term != 'SO:0000159':
+                    v["genomicVariantSequence"] = ''.join(rng.choice('ACGT') for _ in range(1 if so_term == 'SO:1000008' else rng.randint(1, 10)))
+                if i % 2:
+                    v["chromosome"] = chrom
+                else:
+                    v["sequenceOfReferenceAccessionNumber"] = 'RefSeq:' + converter.chrom2ncbi[mod][chrom]
+                v["strains"] = rng.sample(strains, rng.randint(1, min(5, n_strains)))
+            v["alleleId"] = mod + ':VAR' + str(i)
+            previous = v
+            f.write(('' if i == 0 else ",\n") + json.dumps(v))
+        f.write("\n]}\n")
+
+
+# Accumulates the exclusive (self) time of wrapped functions and generators,
+# i.e. excluding time spent in other wrapped calls made from within them
+class StageProfiler:
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def _enter(self):
+        self.stack.append(0.0)
+        return time.perf_counter()
+
+    def _exit(self, stage, start):
+        elapsed = time.perf_counter() - start
+        nested = self.stack.pop()
+        self.times[stage] = self.times.get(stage, 0.0) + elapsed - nested
+        if self.stack:
+            self.stack[-1] += elapsed
+
+    def wrap(self, stage, func):
+        def wrapped(*args, **kwargs):
+            start = self._enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(stage, start)
+        return wrapped
+
+    def wrap_generator(self, stage, func):
+        def wrapped(*args, **kwargs):
+            generator = func(*args, **kwargs)
+            while True:
+                start = self._enter()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    self._exit(stage, start)
+                yield item
+        return wrapped
+
+
+# Runs the converter in this process with its stages instrumented and prints
+# the results as JSON
+def run_one(args):
+    profiler = StageProfiler()
+    converter.stream_json_array = profiler.wrap_generator('parse', converter.stream_json_array)
+    converter.get_refseq_from_fasta = profiler.wrap('reference', converter.get_refseq_from_fasta)
+    converter.get_padbase_from_fasta = profiler.wrap('reference', converter.get_padbase_from_fasta)
+    converter.render_record = profiler.wrap('render', converter.render_record)
+    converter.vcf_records = profiler.wrap_generator('render', converter.vcf_records)
+    converter.unique_lines = profiler.wrap_generator('dedup', converter.unique_lines)
+    converter.ExternalSorter.add = profiler.wrap('sort', converter.ExternalSorter.add)
+    converter.ExternalSorter.sorted_lines = profiler.wrap_generator('sort', converter.ExternalSorter.sorted_lines)
+
+    sys.argv = ['agr_variations_json2vcf.py'] + args.converter_args
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    start = time.perf_counter()
+    converter.main()
+    wall = time.perf_counter() - start
+    sys.stdout.close()
+    sys.stdout = stdout
+
+    # -z/--bgzip output is BGZF, which gzip reads as concatenated members
+    with open(args.out_vcf, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    with (gzip.open(args.out_vcf, 'rt') if compressed else open(args.out_vcf, 'r')) as f:
+        records = sum(1 for line in f if not line.startswith('#'))
+    # ru_maxrss is in kilobytes on Linux; children covers --workers processes
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    print(json.dumps({'wall': wall, 'records': records, 'peak_rss_mb': peak_rss / 1024, 'stages': profiler.times}))
+
+
+def run_suite(args):
+    rng = random.Random(args.seed)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='agr_vcf_benchmark_')
+    os.makedirs(workdir, exist_ok=True)
+    print("Writing synthetic inputs to " + workdir, file=sys.stderr)
+    sequences = write_synthetic_genome(workdir, args.mod, args.chrom_length, rng)
+    write_synthetic_variants(workdir, args.mod, sequences, args.variants, args.strains, args.duplicate_rate, rng)
+    inputs = ['-j', os.path.join(workdir, args.mod + '_VARIATION.json'), '-g', os.path.join(workdir, args.mod + '_GFF.gff'),
+              '-f', os.path.join(workdir, args.mod + '_FASTA.fa'), '-m', args.mod]
+
+    stage_names = ('parse', 'reference', 'render', 'dedup', 'sort')
+    vcf_suffix = '.vcf.gz' if '-z' in args.converter_args or '--bgzip' in args.converter_args else '.vcf'
+    print("\t".join(['#config', 'variants', 'records', 'wall_s', 'variants_per_s', 'peak_rss_mb'] + [s + '_s' for s in stage_names]))
+    for strains in (False, True):
+        for wbhtp in (False, True):
+            config = [flag for flag, used in (('--strains', strains), ('--wbhtp', wbhtp)) if used]
+            out_vcf = os.path.join(workdir, 'out_' + '_'.join(['plain'] + [c.strip('-') for c in config]) + vcf_suffix)
+            result = subprocess.run([sys.executable, os.path.abspath(__file__), 'run', '--out_vcf', out_vcf, '--'] +
+                                    inputs + ['-o', out_vcf] + config + args.converter_args,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True)
+            timings = json.loads(result.stdout)
+            print("\t".join([' '.join(config) or 'default', str(args.variants), str(timings['records']),
+                             '{:.2f}'.format(timings['wall']), '{:.0f}'.format(args.variants / timings['wall']),
+                             '{:.1f}'.format(timings['peak_rss_mb'])] +
+                            ['{:.2f}'.format(timings['stages'].get(s, 0.0)) for s in stage_names]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    stages = subparsers.add_parser('stages', help="Micro-benchmark per-variant conversion stages for each MOD")
+    stages.add_argument("-m", "--mods", nargs='+', default=sorted(converter.chrom2ncbi), help="MODs to benchmark")
+    stages.add_argument("-n", "--variants", type=int, default=20000, help="Number of synthetic variants per MOD")
+    stages.add_argument("-r", "--repeats", type=int, default=5, help="Timing repeats (fastest is reported)")
+    stages.add_argument("-o", "--out", help="Write results TSV to this file as well as stdout")
+    stages.add_argument("-b", "--baseline", help="Results TSV from an earlier run to compare against")
+    stages.add_argument("-t", "--tolerance", type=float, default=1.5, help="Maximum allowed slowdown relative to the baseline")
+
+    suite = subparsers.add_parser('suite', help="End-to-end conversion benchmark on synthetic JSON and FASTA")
+    suite.add_argument("-m", "--mod", default='WB', help="MOD whose contigs are used for the synthetic genome")
+    suite.add_argument("-n", "--variants", type=int, default=100000, help="Number of synthetic variants")
+    suite.add_argument("-l", "--chrom_length", type=int, default=1000000, help="Length of each synthetic contig")
+    suite.add_argument("-s", "--strains", type=int, default=300, help="Number of synthetic strains")
+    suite.add_argument("-d", "--duplicate_rate", type=float, default=0.05, help="Proportion of variants duplicating the previous one")
+    suite.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data")
+    suite.add_argument("-w", "--workdir", help="Directory for synthetic inputs and outputs (default: a new temporary directory)")
+    suite.add_argument("converter_args", nargs='*', help="Extra agr_variations_json2vcf.py options (after --), e.g. -- --workers 4")
+
+    run = subparsers.add_parser('run', help="Run one instrumented conversion (used by suite)")
+    run.add_argument("--out_vcf", required=True, help="Output VCF passed to the converter, for counting records")
+    run.add_argument("converter_args", nargs='*', help="agr_variations_json2vcf.py options (after --)")
+
+    args = parser.parse_args()
+    if args.command == 'stages':
+        run_stages(args)
+    elif args.command == 'suite':
+        run_suite(args)
+    else:
+        run_one(args)
+
+
+if __name__ == '__main__':
+    main()